@@ -35,12 +35,17 @@ class EventHandler:
 import select
 
 
+def _select(handlers, timeout=None):
+    wants_recv = [h for h in handlers if h.wants_to_receive()]
+    wants_send = [h for h in handlers if h.wants_to_send()]
+    # 监听wants_recv, wants_send里面fd的变化，给select提供的对象必须实现fileno()方法
+    can_recv, can_send, _ = select.select(wants_recv, wants_send, [], timeout)
+    return can_recv, can_send
+
+
 def event_loop(handlers):
     while True:
-        wants_recv = [h for h in handlers if h.wants_to_receive()]
-        wants_send = [h for h in handlers if h.wants_to_send()]
-        # 监听wants_recv, wants_send里面fd的变化，给select提供的对象必须实现fileno()方法
-        can_recv, can_send, _ = select.select(wants_recv, wants_send, [])
+        can_recv, can_send = _select(handlers)
         print("can_recv:{}".format(can_recv))
         print("can_send:{}".format(can_send))
         for h in can_recv:
@@ -61,8 +66,10 @@ import time
 
 
 class UDPServer(EventHandler):
-    def __init__(self, address):
+    def __init__(self, address, reuse_port=False):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
         self.sock.bind(address)
 
     def fileno(self):
@@ -92,9 +99,11 @@ if __name__ == "__main__":
 # 实现一个TCP服务器会更加复杂一点，因为每一个客户端都要初始化一个新的处理器对象。
 # 下面是一个TCP应答客户端例子：
 class TCPServer(EventHandler):
-    def __init__(self, address, client_handler, handler_list):
+    def __init__(self, address, client_handler, handler_list, reuse_port=False):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
         self.sock.bind(address)
         self.sock.listen(1)
         self.client_handler = client_handler
@@ -123,7 +132,7 @@ class TCPClient(EventHandler):
 
     def close(self):
         self.sock.close()
-        self.handler_list.remote(self)
+        self.handler_list.remove(self)
 
     def wants_to_send(self):
         return True if self.outgoing else False
@@ -175,7 +184,7 @@ import os
 
 
 class ThreatPoolHandler(EventHandler):
-    def __init__(self, nworkers):
+    def __init__(self, nworkers, executor=ThreadPoolExecutor):
         if os.name == "posix":
             self.signal_done_sock, self.done_sock = socket.socketpair()
         else:
@@ -189,7 +198,7 @@ class ThreatPoolHandler(EventHandler):
             server.close()
 
         self.pending = []
-        self.pool = ThreadPoolExecutor(nworkers)
+        self.pool = executor(nworkers)
 
     def fileno(self):
         return self.done_sock.fileno()
@@ -203,7 +212,7 @@ class ThreatPoolHandler(EventHandler):
 
     # 在线程池运行一个函数
     def run(self, func, args=(), kwargs={}, *, callback):
-        r = self.pool.submit(func, args, kwargs)
+        r = self.pool.submit(func, *args, **kwargs)
         # 添加完成回调函数，当这个线程完成任务后会把结果存在r对象中
         r.add_done_callback(lambda r: self._complete(callback, r))
 
@@ -261,3 +270,843 @@ class ThreatPoolHandler(EventHandler):
 # 已经阅读完了这一小节，那么你应该使用这里的代码吗？也许不会。你应该选择一个可以完成同样任
 # 务的高级框架。 不过，如果你理解了基本原理，你就能理解这些框架所使用的核心技术。 作为对
 # 回调函数编程的替代，事件驱动编码有时候会使用到协程，参考12.12小节的一个例子。
+
+
+# 扩展：使用selectors代替select
+# 上面的 event_loop() 每次循环都要询问所有处理器的 wants_to_receive() 和
+# wants_to_send() ，再把整个列表交给 select() ，所以每次唤醒的开销是O(n)的，并且
+# select() 最多只能监听 FD_SETSIZE（通常是1024）个文件描述符。当有成千上万个空闲连接
+# 的时候，这种方式就不可行了。
+#
+# selectors 模块的 DefaultSelector 会选择当前平台最高效的实现（Linux上是epoll，BSD和
+# macOS上是kqueue）。这些实现会在内核中保存关注的fd集合，所以只需要在处理器关注的事件
+# 发生变化时调用 register()/modify()/unregister() ，每次循环的开销只跟活跃的socket数
+# 量有关，而不是socket总数：
+import selectors
+
+
+class SelectorEventLoop:
+    def __init__(self, handlers=()):
+        self._selector = selectors.DefaultSelector()
+        self._registered = {}  # handler -> (fd, 当前注册的事件)
+        for h in handlers:
+            self.append(h)
+
+    # 提供和list一样的append()/remove()，这样TCPServer和TCPClient可以直接把
+    # 事件循环当成handler_list使用
+    def append(self, h):
+        self._registered[h] = (h.fileno(), 0)
+        self.update(h)
+
+    def remove(self, h):
+        fd, events = self._registered.pop(h)
+        if events:
+            # 用fd注销，这样socket已经被关闭时也不需要遍历查找
+            self._selector.unregister(fd)
+
+    def __len__(self):
+        return len(self._registered)
+
+    def update(self, h):
+        """重新询问处理器关注的事件，只有发生变化时才修改selector"""
+        if h not in self._registered:
+            return
+        fd, old = self._registered[h]
+        new = 0
+        if h.wants_to_receive():
+            new |= selectors.EVENT_READ
+        if h.wants_to_send():
+            new |= selectors.EVENT_WRITE
+        if new == old:
+            return
+        if not old:
+            self._selector.register(fd, new, h)
+        elif not new:
+            self._selector.unregister(fd)
+        else:
+            self._selector.modify(fd, new, h)
+        self._registered[h] = (fd, new)
+
+    def run_once(self, timeout=None):
+        events = self._selector.select(timeout)
+        for key, mask in events:
+            h = key.data
+            if mask & selectors.EVENT_READ:
+                h.handle_receive()
+            # handle_receive()可能已经关闭并移除了这个处理器
+            if mask & selectors.EVENT_WRITE and h in self._registered:
+                h.handle_send()
+            # 处理器关注的事件只会在处理事件之后改变，所以只需要检查活跃的处理器
+            self.update(h)
+        return len(events)
+
+    def run(self):
+        while True:
+            self.run_once()
+
+    def close(self):
+        self._selector.close()
+
+
+# 使用方式跟之前一样，只是把事件循环对象当成处理器列表传进去：
+#
+# if __name__ == "__main__":
+#     loop = SelectorEventLoop()
+#     loop.append(TCPServer(("", 16000), TCPEchoClient, loop))
+#     loop.run()
+#
+# 要注意的是，事件循环只会在处理器被触发之后重新检查它关注的事件。如果在其他地方改变了
+# 一个处理器的状态（比如在线程池的回调函数中往另一个客户端的outgoing写数据），需要调用
+# loop.update(h) 来通知事件循环。
+#
+# 下面是一个简单的基准测试，创建n对socket，每轮只让其中一个变得可读，然后比较两种事件
+# 循环处理一次唤醒的耗时。10000个连接需要20000个fd，必要时先用 ulimit -n 调高限制。
+# select() 在fd超过FD_SETSIZE时会直接抛出 ValueError：
+class _BenchHandler(EventHandler):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_to_receive(self):
+        return True
+
+    def handle_receive(self):
+        self.sock.recv(1)
+
+
+def bench_event_loops(sizes=(100, 1000, 10000), rounds=1000):
+    import random
+    for n in sizes:
+        pairs = []
+        try:
+            for _ in range(n):
+                pairs.append(socket.socketpair())
+        except OSError as e:
+            # 一般是超过了 ulimit -n 的限制
+            for a, b in pairs:
+                a.close()
+                b.close()
+            print("{:6d} conns  {}".format(n, e))
+            continue
+        handlers = [_BenchHandler(a) for a, b in pairs]
+        try:
+            try:
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    random.choice(pairs)[1].send(b"x")
+                    can_recv, can_send = _select(handlers)
+                    for h in can_recv:
+                        h.handle_receive()
+                t_select = (time.perf_counter() - start) / rounds * 1e6
+                t_select = "{:10.1f} us".format(t_select)
+            except ValueError as e:
+                t_select = str(e)
+
+            loop = SelectorEventLoop(handlers)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                random.choice(pairs)[1].send(b"x")
+                loop.run_once()
+            t_selector = (time.perf_counter() - start) / rounds * 1e6
+            loop.close()
+            print("{:6d} conns  select: {}  selectors: {:10.1f} us".format(
+                n, t_select, t_selector))
+        finally:
+            for a, b in pairs:
+                a.close()
+                b.close()
+
+# bench_event_loops()
+# 在一台 ulimit -n 的硬限制是20000的Linux机器上，10000个连接需要的fd超过了限制：
+#    100 conns  select:       58.2 us  selectors:        6.9 us
+#   1000 conns  select: filedescriptor out of range in select()  selectors:        8.6 us
+#  10000 conns  [Errno 24] Too many open files
+# 在同一台机器上单独测试select()还能工作的400个连接，以及fd限制以内的9000个连接：
+# bench_event_loops(sizes=(400,))
+#    400 conns  select:      176.9 us  selectors:        6.8 us
+# bench_event_loops(sizes=(9000,))
+#   9000 conns  select: filedescriptor out of range in select()  selectors:       11.1 us
+# select()的耗时跟连接总数成正比，而selectors基本保持不变。
+
+
+# 扩展：避免复制的发送缓冲区
+# TCPClient.handle_send() 中的 self.outgoing = self.outgoing[nsent:] 每次部分发送后都
+# 会把剩下的数据完整复制一遍。如果要回显的数据很大而对端读得很慢，总的复制量是平方级的。
+# 更好的方式是把待发送的数据按块放进一个队列，每一块用 memoryview 包装，发送之后只是
+# 移动 memoryview 的切片（参考11.13小节，memoryview切片不会复制数据）。支持
+# sendmsg() 的平台上还可以一次把多个块交给内核（scatter/gather），减少系统调用：
+from collections import deque
+from itertools import islice
+
+
+class OutputQueue:
+    def __init__(self, max_iov=64):
+        self._chunks = deque()
+        self._nbytes = 0
+        self._max_iov = max_iov  # 一次sendmsg()最多发送的块数
+
+    def __len__(self):
+        return self._nbytes
+
+    def extend(self, data):
+        # 和bytearray.extend()同名，这样TCPEchoClient的代码可以不用修改。
+        # 放进队列的数据在发送完之前不能再被修改
+        if data:
+            self._chunks.append(memoryview(data).cast("B"))
+            self._nbytes += len(data)
+
+    def send(self, sock):
+        if hasattr(sock, "sendmsg"):
+            nsent = sock.sendmsg(list(islice(self._chunks, self._max_iov)))
+        else:
+            nsent = sock.send(self._chunks[0])
+        self._consume(nsent)
+        return nsent
+
+    def _consume(self, nbytes):
+        self._nbytes -= nbytes
+        while nbytes:
+            chunk = self._chunks[0]
+            if nbytes >= len(chunk):
+                self._chunks.popleft()
+                nbytes -= len(chunk)
+            else:
+                self._chunks[0] = chunk[nbytes:]  # 只移动切片，不复制数据
+                nbytes = 0
+
+
+# 另外，如果对端一直不读取数据，发送缓冲区会无限增长。下面的客户端处理器在缓冲的数据超过
+# max_buffered 时让 wants_to_receive() 返回False，暂停读取直到数据被发送出去（背压）。
+# 需要配合上面的 SelectorEventLoop 使用，它会在每次发送之后重新检查关注的事件：
+class BufferedTCPClient(TCPClient):
+    max_buffered = 1 << 20
+
+    def __init__(self, sock, handler_list):
+        super().__init__(sock, handler_list)
+        self.outgoing = OutputQueue()
+
+    def wants_to_receive(self):
+        return len(self.outgoing) < self.max_buffered and super().wants_to_receive()
+
+    def handle_send(self):
+        self.outgoing.send(self.sock)
+
+
+class BufferedTCPEchoClient(BufferedTCPClient, TCPEchoClient):
+    pass
+
+
+# 下面的基准测试通过回显服务器传输total字节的数据，客户端在一个线程中发送，同时在另一个
+# 线程中接收，比较两种客户端处理器的吞吐量和进程的峰值内存（ru_maxrss是整个进程的峰值，
+# 所以每次测试要在一个单独的进程中运行）：
+import resource
+import threading
+
+
+def bench_echo_throughput(client_handler, total=1 << 30, chunk=1 << 16, delay=0.0):
+    loop = SelectorEventLoop()
+    server = TCPServer(("127.0.0.1", 0), client_handler, loop)
+    loop.append(server)
+    addr = server.sock.getsockname()
+    done = threading.Event()
+
+    def client():
+        sock = socket.create_connection(addr)
+        payload = b"x" * chunk
+
+        def sender():
+            for _ in range(total // chunk):
+                sock.sendall(payload)
+
+        t = threading.Thread(target=sender)
+        t.start()
+        time.sleep(delay)  # 模拟一个读取很慢的对端
+        received = 0
+        buf = bytearray(1 << 20)
+        while received < total // chunk * chunk:
+            received += sock.recv_into(buf)
+        t.join()
+        sock.close()
+        done.set()
+
+    start = time.perf_counter()
+    threading.Thread(target=client).start()
+    while not done.is_set() or len(loop) > 1:
+        loop.run_once(0.1)
+    elapsed = time.perf_counter() - start
+    loop.remove(server)
+    server.sock.close()
+    loop.close()
+    # Linux上ru_maxrss的单位是KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("{:24s} delay={:.1f} {:8.1f} MiB/s {:8.0f} MiB".format(
+        client_handler.__name__, delay, total / elapsed / (1 << 20), peak))
+
+# bench_echo_throughput(TCPEchoClient)
+# bench_echo_throughput(BufferedTCPEchoClient)
+# bench_echo_throughput(TCPEchoClient, delay=1.0)
+# bench_echo_throughput(BufferedTCPEchoClient, delay=1.0)
+# 在单核机器上每个调用在一个单独的进程中运行，结果如下（最后一列是进程的峰值内存）：
+# TCPEchoClient            delay=0.0    380.8 MiB/s       17 MiB
+# BufferedTCPEchoClient    delay=0.0    385.0 MiB/s       18 MiB
+# TCPEchoClient            delay=1.0    485.3 MiB/s      650 MiB
+# BufferedTCPEchoClient    delay=1.0    297.8 MiB/s       17 MiB
+# 当对端正常读取时（delay=0），两者的吞吐量和内存占用都差不多。在对端暂停读取的1秒内，
+# TCPEchoClient 会继续读取并把数据全部缓存在内存中，峰值内存涨到了650MiB，发送方一直没有
+# 被阻塞，所以它的吞吐量反而更高；BufferedTCPEchoClient 缓存到1MiB后就停止读取，让TCP的
+# 流量控制阻塞发送方，总耗时多了差不多这1秒，但是内存占用是有上限的。
+
+
+# 扩展：批量处理已完成的工作
+# ThreatPoolHandler 有两个问题。第一，每完成一个工作就要写一个字节，事件循环再用
+# recv(1) 一个一个地读出来，每个工作都要两次系统调用。第二，工作线程在没有加锁的情况下
+# 往 self.pending 里添加结果，而事件循环在遍历完之后直接执行 self.pending = [] ，
+# 在这期间完成的工作会被丢掉。
+#
+# 下面的处理器用一个锁保护完成队列，只有在队列从空变为非空的时候才写一个字节来唤醒事件
+# 循环，事件循环每次醒来时一次性读出所有唤醒字节并取走整个队列：
+class BatchedPoolHandler(ThreatPoolHandler):
+    def __init__(self, nworkers, executor=ThreadPoolExecutor):
+        super().__init__(nworkers, executor)
+        self.pending = deque()
+        self._lock = threading.Lock()
+        self.done_sock.setblocking(False)
+
+    def _complete(self, callback, r):
+        with self._lock:
+            wakeup = not self.pending
+            self.pending.append((callback, r.result()))
+        # 队列原来不为空的话，事件循环一定已经被唤醒过了
+        if wakeup:
+            self.signal_done_sock.send(b"x")
+
+    def handle_receive(self):
+        # 必须先读唤醒字节再取队列。字节总是在结果放入队列之后才写入的，所以读到的每一个
+        # 字节对应的结果都会在下面被取走；取走之后才完成的工作会重新写一个字节
+        try:
+            self.done_sock.recv(4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self.pending = self.pending, deque()
+        for callback, result in pending:
+            callback(result)
+
+
+# 因为回调函数总是在事件循环中执行，所以对于CPU密集型的函数，可以把 executor 换成
+# ProcessPoolExecutor 来绕开GIL（函数和参数必须能被pickle序列化）：
+#
+# pool = BatchedPoolHandler(4, executor=ProcessPoolExecutor)
+# handlers = [pool, UDPFibServer(("", 16000))]
+# event_loop(handlers)
+#
+# 下面的基准测试提交njobs个很小的工作，统计每秒能完成多少个。ThreatPoolHandler 可能会
+# 因为上面提到的竞争条件丢失结果，所以设置了一个超时：
+from concurrent.futures import ProcessPoolExecutor
+
+
+def bench_pool_handler(handler_class, njobs=100000, nworkers=4,
+                       executor=ThreadPoolExecutor, timeout=30):
+    pool = handler_class(nworkers, executor)
+    loop = SelectorEventLoop([pool])
+    done = 0
+
+    def callback(result):
+        nonlocal done
+        done += 1
+
+    start = time.perf_counter()
+    for n in range(njobs):
+        pool.run(pow, (n, 2), callback=callback)
+    deadline = start + timeout
+    while done < njobs and time.perf_counter() < deadline:
+        loop.run_once(0.1)
+    elapsed = time.perf_counter() - start
+    loop.close()
+    pool.pool.shutdown()
+    print("{:20s} {:20s} {:10.0f} jobs/s  lost: {}".format(
+        handler_class.__name__, executor.__name__, done / elapsed, njobs - done))
+
+# bench_pool_handler(ThreatPoolHandler)
+# bench_pool_handler(BatchedPoolHandler)
+# bench_pool_handler(BatchedPoolHandler, njobs=10000, executor=ProcessPoolExecutor)
+# 结果大致如下：
+# ThreatPoolHandler    ThreadPoolExecutor        25953 jobs/s  lost: 0
+# BatchedPoolHandler   ThreadPoolExecutor        38002 jobs/s  lost: 0
+# BatchedPoolHandler   ProcessPoolExecutor        5887 jobs/s  lost: 0
+# 对于pow()这样很小的函数，进程池的开销主要在进程间传递参数和结果上，只有当函数本身的计算
+# 量足够大时才值得使用。
+
+
+# 扩展：定时器和空闲连接超时
+# 上面的事件循环都会在 select() 中无限期地阻塞，没有超时的概念。这样一来，死掉的对端留下
+# 的空闲连接永远不会被清理，也没办法执行周期性的工作。
+#
+# 一个简单的做法是用 heapq 维护一个按到期时间排序的定时器堆，每次等待I/O时把超时时间设为
+# 最近一个定时器的剩余时间，醒来之后执行所有已到期的定时器。添加和取出定时器都是O(log n)，
+# 取消定时器只是打上标记，等它到达堆顶时直接丢弃：
+import heapq
+import itertools
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerEventLoop(SelectorEventLoop):
+    def __init__(self, handlers=()):
+        self._timers = []
+        self._seq = itertools.count()  # 到期时间相同时按添加顺序执行
+        super().__init__(handlers)
+
+    def call_at(self, when, callback, *args):
+        """在time.monotonic()到达when时执行callback(*args)"""
+        timer = Timer(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._seq), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """delay秒之后执行callback(*args)"""
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def run_once(self, timeout=None):
+        if self._timers:
+            wait = max(0, self._timers[0][0] - time.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+        nevents = super().run_once(timeout)
+        self._run_timers()
+        return nevents
+
+    def _run_timers(self):
+        now = time.monotonic()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            when, _, timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+# 有了定时器，就可以给TCP客户端加上空闲超时了。如果每次收发数据都重新设置定时器，会产生
+# 大量的堆操作，所以这里只记录最后一次活动的时间，定时器到期时再检查是否真的空闲，没有的
+# 话就按剩余时间重新设置：
+class IdleTimeoutMixin:
+    """
+    给TCPClient的子类加上空闲超时，handler_list必须是TimerEventLoop
+    """
+    idle_timeout = 60.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_active = time.monotonic()
+        self._idle_timer = self.handler_list.call_later(self.idle_timeout,
+                                                        self._check_idle)
+
+    def _check_idle(self):
+        idle = time.monotonic() - self.last_active
+        if idle >= self.idle_timeout:
+            self._idle_timer = None
+            self.close()
+        else:
+            self._idle_timer = self.handler_list.call_later(
+                self.idle_timeout - idle, self._check_idle)
+
+    def handle_receive(self):
+        self.last_active = time.monotonic()
+        super().handle_receive()
+
+    def handle_send(self):
+        self.last_active = time.monotonic()
+        super().handle_send()
+
+    def close(self):
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        super().close()
+
+
+class IdleTCPEchoClient(IdleTimeoutMixin, BufferedTCPEchoClient):
+    idle_timeout = 300.0
+
+
+# 周期性的工作可以让回调函数重新设置自己：
+#
+# if __name__ == "__main__":
+#     loop = TimerEventLoop()
+#     loop.append(TCPServer(("", 16000), IdleTCPEchoClient, loop))
+#
+#     def report():
+#         print("connections:", len(loop) - 1)
+#         loop.call_later(10, report)
+#
+#     report()
+#     loop.run()
+#
+# 下面的基准测试添加ntimers个在1秒内随机到期的定时器，然后运行事件循环直到它们全部执行完：
+def bench_timers(ntimers=1000000, cancel_ratio=0.0):
+    import random
+    loop = TimerEventLoop()
+    fired = 0
+
+    def callback():
+        nonlocal fired
+        fired += 1
+
+    start = time.perf_counter()
+    timers = [loop.call_later(random.random(), callback) for _ in range(ntimers)]
+    t_schedule = time.perf_counter() - start
+    for timer in random.sample(timers, int(ntimers * cancel_ratio)):
+        timer.cancel()
+    del timers
+
+    start = time.perf_counter()
+    while loop._timers:
+        loop.run_once()
+    t_run = time.perf_counter() - start
+    loop.close()
+    print("{} timers: schedule {:.2f}s ({:.2f} us/timer), "
+          "run {:.2f}s, fired {}".format(ntimers, t_schedule,
+                                         t_schedule / ntimers * 1e6, t_run, fired))
+
+# bench_timers()
+# 1000000 timers: schedule 3.77s (3.77 us/timer), run 6.86s, fired 1000000
+# 每个定时器的开销只有几微秒，对于按秒计算的空闲超时来说完全够用，而且不再需要一个单独的
+# 线程去清理空闲连接。如果需要的是百万级别、精度要求不高的超时，可以考虑分层时间轮，
+# 它添加和取消定时器都是O(1)的。
+
+
+# 扩展：使用SO_REUSEPORT的多进程模式
+# 单个事件循环只能使用一个CPU核心。在Linux（3.9以上）和BSD上，可以让多个进程各自创建
+# 一个设置了 SO_REUSEPORT 选项的socket并绑定到同一个端口，内核会把新的连接或数据报按
+# 地址哈希分配给这些socket。这样每个进程运行自己独立的事件循环，进程之间不需要任何同步。
+#
+# 下面的 PreforkServer 会fork出nworkers个工作进程，每个进程调用 make_servers(loop)
+# 创建监听用的处理器（必须传入reuse_port=True）。工作进程定期把统计信息通过一个队列上报
+# 给父进程。父进程收到SIGHUP时会平滑重启：先启动一组新的工作进程，再让旧的进程停止接受
+# 新连接，等已有的连接处理完（最多drain_timeout秒）后退出：
+import multiprocessing
+import queue
+import signal
+
+
+class PreforkServer:
+    def __init__(self, make_servers, nworkers=os.cpu_count(),
+                 report_interval=1.0, drain_timeout=30.0):
+        self.make_servers = make_servers
+        self.nworkers = nworkers
+        self.report_interval = report_interval
+        self.drain_timeout = drain_timeout
+        # 工作进程需要继承make_servers，所以这里固定使用fork
+        self._ctx = multiprocessing.get_context("fork")
+        self._stats_queue = self._ctx.Queue()
+        self._workers = {}  # pid -> Process
+        self._retiring = []  # 平滑重启时正在退出的旧进程
+        self._stats = {}  # pid -> 最近一次上报的统计信息
+        self._running = False
+        self._reload = False
+
+    def _worker(self):
+        stopping = False
+
+        def stop(signo, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        # 由父进程统一处理这些信号
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        loop = TimerEventLoop()
+        listeners = self.make_servers(loop)
+        for server in listeners:
+            loop.append(server)
+        stats = {"pid": os.getpid(), "events": 0, "connections": 0}
+
+        def report():
+            stats["connections"] = len(loop) - len(listeners)
+            self._stats_queue.put(dict(stats))
+            loop.call_later(self.report_interval, report)
+
+        report()
+        while not stopping:
+            stats["events"] += loop.run_once()
+
+        # 停止接受新的连接，等待已有的连接关闭。注意Linux上关闭一个SO_REUSEPORT的socket
+        # 时，它的接受队列中还没有accept()的连接会被重置
+        for server in listeners:
+            loop.remove(server)
+            server.sock.close()
+        listeners = []
+        deadline = time.monotonic() + self.drain_timeout
+        while len(loop) and time.monotonic() < deadline:
+            stats["events"] += loop.run_once(deadline - time.monotonic())
+        stats["connections"] = len(loop)
+        self._stats_queue.put(stats)
+
+    def _spawn(self):
+        p = self._ctx.Process(target=self._worker)
+        p.start()
+        self._workers[p.pid] = p
+
+    def start(self):
+        self._running = True
+        for _ in range(self.nworkers):
+            self._spawn()
+
+    def reload(self):
+        self._reload = False
+        old = list(self._workers.values())
+        # 新的进程先绑定端口，这样重启期间始终有进程在接受连接
+        for _ in range(self.nworkers):
+            self._spawn()
+        for p in old:
+            del self._workers[p.pid]
+            os.kill(p.pid, signal.SIGTERM)
+            self._retiring.append(p)
+
+    def stop(self):
+        self._running = False
+        for p in list(self._workers.values()) + self._retiring:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+        # 一边等待一边读取统计信息：工作进程要等队列的数据全部写进管道才能退出，管道满了
+        # 时父进程如果只是 join() 就会死锁
+        procs = list(self._workers.values()) + self._retiring
+        while procs:
+            self.poll_stats(0.1)
+            procs = [p for p in procs if p.exitcode is None]
+        self._workers.clear()
+        self._retiring = []
+        self.poll_stats()
+
+    def poll_stats(self, timeout=0):
+        """收集工作进程上报的统计信息，最多等待timeout秒"""
+        try:
+            while True:
+                s = self._stats_queue.get(timeout=timeout)
+                self._stats[s["pid"]] = s
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def stats(self):
+        """汇总所有工作进程的统计信息，events包括已经退出的进程"""
+        return {
+            "workers": len(self._workers),
+            "events": sum(s["events"] for s in self._stats.values()),
+            "connections": sum(s["connections"] for pid, s in self._stats.items()
+                               if pid in self._workers),
+        }
+
+    def _reap(self):
+        self._retiring = [p for p in self._retiring if p.is_alive()]
+        for pid, p in list(self._workers.items()):
+            if not p.is_alive():
+                # 工作进程意外退出，重新启动一个
+                del self._workers[pid]
+                if self._running:
+                    self._spawn()
+
+    def serve_forever(self):
+        def reload(signo, frame):
+            self._reload = True
+
+        def stop(signo, frame):
+            self._running = False
+
+        signal.signal(signal.SIGHUP, reload)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.start()
+        while self._running:
+            self.poll_stats(self.report_interval)
+            if self._reload:
+                self.reload()
+            self._reap()
+        self.stop()
+
+
+# 使用的时候，把创建服务器的代码放进一个函数里：
+#
+# def make_servers(loop):
+#     return [UDPTimeServer(("", 14000), reuse_port=True),
+#             UDPEchoServer(("", 15000), reuse_port=True),
+#             TCPServer(("", 16000), IdleTCPEchoClient, loop, reuse_port=True)]
+#
+# if __name__ == "__main__":
+#     PreforkServer(make_servers, nworkers=16).serve_forever()
+#
+# 然后就可以用 kill -HUP <父进程pid> 平滑重启所有工作进程。
+#
+# 下面的基准测试用nclients个客户端进程向UDP回显服务器发送请求并等待响应，统计不同工作进程
+# 数量下每秒处理的请求数。每个客户端的源端口不同，所以请求会被分散到各个工作进程上：
+def _udp_blaster(addr, duration, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.5)
+    n = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        sock.sendto(b"x", addr)
+        try:
+            sock.recvfrom(64)
+            n += 1
+        except socket.timeout:
+            pass
+    sock.close()
+    results.put(n)
+
+
+def bench_prefork(nworkers_list=(1, 2, 4, 8, 16), nclients=32, duration=5.0,
+                  addr=("127.0.0.1", 15500)):
+    ctx = multiprocessing.get_context("fork")
+    for nworkers in nworkers_list:
+        server = PreforkServer(lambda loop: [UDPEchoServer(addr, reuse_port=True)],
+                               nworkers)
+        server.start()
+        time.sleep(0.5)  # 等待工作进程绑定端口
+        results = ctx.Queue()
+        clients = [ctx.Process(target=_udp_blaster, args=(addr, duration, results))
+                   for _ in range(nclients)]
+        for p in clients:
+            p.start()
+        total = sum(results.get() for _ in clients)
+        for p in clients:
+            p.join()
+        server.stop()
+        print("{:3d} workers: {:10.0f} req/s  (workers handled {} events)".format(
+            nworkers, total / duration, server.stats()["events"]))
+
+# bench_prefork()
+# 在只有一个核心的机器上（bench_prefork(nworkers_list=(1, 2, 4))），增加工作进程并不会
+# 明显提高吞吐量，差别基本上是噪声：
+#   1 workers:      41463 req/s  (workers handled 207315 events)
+#   2 workers:      47587 req/s  (workers handled 237935 events)
+#   4 workers:      39477 req/s  (workers handled 197385 events)
+# 在多核机器上，只要客户端足够多，吞吐量应该随工作进程数量增长，直到核心数量（要注意
+# 客户端进程本身也会占用CPU）。
+
+
+# 扩展：批量处理UDP数据报
+# UDPTimeServer 和 UDPEchoServer 每次可读事件只处理一个数据报，也就是说每个数据报都要
+# 经过一次 select() ；而且每次都调用 recvfrom() 创建新的bytes对象，每次都重新格式化并
+# 编码 time.ctime() 。
+#
+# 下面的服务器把socket设置为非阻塞模式，每次可读时循环读取直到 BlockingIOError（最多
+# batch_size个），用 recvfrom_into() 把数据读进预先分配好的缓冲区中。时间字符串每秒
+# 只编码一次：
+class BatchedUDPServer(UDPServer):
+    batch_size = 64
+
+    def __init__(self, address, reuse_port=False, bufsize=8192):
+        super().__init__(address, reuse_port)
+        self.sock.setblocking(False)
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+
+    def handle_receive(self):
+        for _ in range(self.batch_size):
+            try:
+                nbytes, addr = self.sock.recvfrom_into(self._buf)
+            except BlockingIOError:
+                break
+            # 缓冲区在下一次接收时会被覆盖，所以data只能在这次调用中使用
+            self.handle_datagram(self._view[:nbytes], addr)
+
+    def handle_datagram(self, data, addr):
+        pass
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except BlockingIOError:
+            pass  # 发送缓冲区满了，跟网络上丢包一样直接丢弃
+
+
+class BatchedUDPTimeServer(BatchedUDPServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._now = None
+        self._reply = None
+
+    def handle_receive(self):
+        now = int(time.time())
+        if now != self._now:
+            self._now = now
+            self._reply = time.ctime(now).encode("ascii")
+        super().handle_receive()
+
+    def handle_datagram(self, data, addr):
+        self.sendto(self._reply, addr)
+
+
+class BatchedUDPEchoServer(BatchedUDPServer):
+    def handle_datagram(self, data, addr):
+        self.sendto(data, addr)
+
+
+# 下面的基准测试fork出一个进程不断向服务器发送数据报，另一个进程用同一个socket接收并统计
+# 响应的数量，以此计算服务器每秒处理的数据报（pps）：
+def _udp_flood(sock, addr, duration):
+    payload = b"x" * 32
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            sock.sendto(payload, addr)
+        except OSError:
+            pass
+
+
+def _udp_count(sock, duration, results):
+    sock.settimeout(0.2)
+    buf = bytearray(8192)
+    n = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            sock.recv_into(buf)
+            n += 1
+        except socket.timeout:
+            pass
+    results.put(n)
+
+
+def bench_udp_pps(server_class, duration=5.0, addr=("127.0.0.1", 15600)):
+    ctx = multiprocessing.get_context("fork")
+    server = server_class(addr)
+    loop = SelectorEventLoop([server])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_udp_flood, args=(sock, addr, duration)),
+             ctx.Process(target=_udp_count, args=(sock, duration, results))]
+    for p in procs:
+        p.start()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        loop.run_once(0.1)
+    n = results.get()
+    for p in procs:
+        p.join()
+    loop.close()
+    sock.close()
+    server.sock.close()
+    print("{:22s} {:10.0f} pps".format(server_class.__name__, n / duration))
+
+# for cls in (UDPEchoServer, BatchedUDPEchoServer, UDPTimeServer, BatchedUDPTimeServer):
+#     bench_udp_pps(cls)
+# 在一台单核机器上（发送和统计的进程也在抢同一个核心）的结果：
+# UDPEchoServer               35542 pps
+# BatchedUDPEchoServer        54897 pps
+# UDPTimeServer               30778 pps
+# BatchedUDPTimeServer        54717 pps
+# Linux上的 recvmmsg()/sendmmsg() 可以在一次系统调用中收发多个数据报，但是socket模块
+# 并没有提供，这里只能做到每个数据报一次recvfrom_into()，省掉的是select()和内存分配。
@@ -21,6 +21,8 @@ class ActorExit(Exception):
 
 
 class Actor:
+    supervisor = None  # 见后面的Supervisor
+
     def __init__(self):
         self._mailbox = Queue()
 
@@ -52,6 +54,10 @@ class Actor:
             self.run()
         except ActorExit:
             pass
+        except Exception as e:
+            if self.supervisor is None:
+                raise
+            self.supervisor.child_failed(self, e)
         finally:
             self._terminated.set()
 
@@ -132,40 +138,913 @@ p.close()  # 抛出GeneratorExit异常
 
 
 # 作为另外一个例子，下面的actor允许在一个工作者中运行任意的函数， 并且通过一个特殊的Result对象返回结果：
+class Result:
+    def __init__(self):
+        self._evt = Event()
+        self._result = None
+
+    def set_result(self, value):
+        self._result = value
+        self._evt.set()
+
+    def result(self):
+        self._evt.wait()
+        return self._result
+
+
+class Worker(Actor):
+    def submit(self, func, *args, **kwargs):
+        r = Result()
+        self.send((func, args, kwargs, r))
+        return r
+
+    def run(self):
+        while True:
+            func, args, kwargs, r = self.recv()
+            r.set_result(func(*args, **kwargs))
+
+
+# Example use
+# worker = Worker()
+# worker.start()
+# r = worker.submit(pow, 2, 3)
+# print(r.result())
+# 最后，“发送”一个任务消息的概念可以被扩展到多进程甚至是大型分布式系统中去。 例如，
+# 一个类actor对象的 send() 方法可以被编程让它能在一个套接字连接上传输数据 或通过某
+# 些消息中间件（比如AMQP、ZMQ等）来发送。
+
+
+# 扩展：有界的邮箱和背压
+# Actor 的邮箱是一个无界的 Queue() ，如果发送者比 run() 处理得快，邮箱会无限增长，最后
+# 耗尽内存。下面的邮箱可以设置最大长度，以及邮箱满了之后的处理策略：阻塞发送者、丢弃最老
+# 的消息、丢弃新的消息或者抛出异常。邮箱还会记录一些统计信息：当前和最大的深度、丢弃的
+# 消息数、消息在邮箱中等待的时间以及发送者被阻塞的时间：
+from collections import deque
+from threading import Lock, Condition
+import time
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+RAISE = "raise"
+
+
+class MailboxFull(Exception):
+    pass
+
+
+class Mailbox:
+    def __init__(self, maxsize=0, policy=BLOCK):
+        self.maxsize = maxsize  # 0表示无界
+        self.policy = policy
+        self._queue = deque()  # (放入的时间, 消息)
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._sent = 0
+        self._received = 0
+        self._dropped = 0
+        self._max_depth = 0
+        self._wait_time = 0.0  # 消息在邮箱中等待的总时间
+        self._max_wait = 0.0
+        self._blocked_time = 0.0  # 发送者被阻塞的总时间
+
+    def put(self, msg, nowait=False, force=False, front=False):
+        """
+        放入一个消息，返回是否放入成功。nowait为True时不会阻塞也不会抛出异常，
+        force为True时忽略长度限制（用于ActorExit这样的控制消息），front为True时
+        放在邮箱的最前面
+        """
+        with self._lock:
+            if self.maxsize and len(self._queue) >= self.maxsize and not force:
+                if self.policy == DROP_OLDEST:
+                    # 只丢掉最后一个ActorExit之后最老的消息。ActorExit之前的消息还会被处理，
+                    # 不能为了一个排在ActorExit后面、可能永远不会被处理的消息把它们丢掉；
+                    # 后面没有消息可以丢时，丢掉新的消息
+                    start = 0
+                    for i in range(len(self._queue) - 1, -1, -1):
+                        if self._queue[i][1] is ActorExit:
+                            start = i + 1
+                            break
+                    self._dropped += 1
+                    if start == len(self._queue):
+                        return False
+                    del self._queue[start]
+                elif self.policy == DROP_NEWEST:
+                    self._dropped += 1
+                    return False
+                elif nowait:
+                    return False
+                elif self.policy == RAISE:
+                    raise MailboxFull("mailbox is full ({} messages)".format(self.maxsize))
+                else:
+                    start = time.monotonic()
+                    while len(self._queue) >= self.maxsize:
+                        self._not_full.wait()
+                    self._blocked_time += time.monotonic() - start
+            if front:
+                self._queue.appendleft((time.monotonic(), msg))
+            else:
+                self._queue.append((time.monotonic(), msg))
+            self._sent += 1
+            if len(self._queue) > self._max_depth:
+                self._max_depth = len(self._queue)
+            self._not_empty.notify()
+            return True
+
+    def get(self):
+        with self._lock:
+            while not self._queue:
+                self._not_empty.wait()
+            t, msg = self._queue.popleft()
+            wait = time.monotonic() - t
+            self._wait_time += wait
+            if wait > self._max_wait:
+                self._max_wait = wait
+            self._received += 1
+            self._not_full.notify()
+            return msg
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __contains__(self, msg):
+        with self._lock:
+            return any(item[1] is msg for item in self._queue)
+
+    def remove_front(self, msg):
+        """如果邮箱最前面的消息是msg就删除它，返回是否删除了"""
+        with self._lock:
+            if not self._queue or self._queue[0][1] is not msg:
+                return False
+            self._queue.popleft()
+            self._not_full.notify()
+            return True
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self._max_depth,
+                "sent": self._sent,
+                "received": self._received,
+                "dropped": self._dropped,
+                "wait_time": self._wait_time,
+                "avg_wait": self._wait_time / self._received if self._received else 0.0,
+                "max_wait": self._max_wait,
+                "blocked_time": self._blocked_time,
+            }
+
+
+# 使用这个邮箱的actor跟普通的Actor一样使用，只是多了一个不会阻塞的 try_send() 和
+# metrics() 。ActorExit 总是能放进邮箱，不会因为邮箱满了而被丢弃：
+class BoundedActor(Actor):
+    def __init__(self, maxsize=1000, policy=BLOCK):
+        self._mailbox = Mailbox(maxsize, policy)
+
+    def send(self, msg):
+        """发送一个消息给actor，邮箱满了时按照policy处理"""
+        self._mailbox.put(msg)
+
+    def try_send(self, msg):
+        """发送一个消息给actor，不会阻塞，返回消息是否被放入了邮箱"""
+        return self._mailbox.put(msg, nowait=True)
+
+    def close(self):
+        self._mailbox.put(ActorExit, force=True)
+
+    def metrics(self):
+        return self._mailbox.metrics()
+
+
+# Example use
+# class BoundedPrintActor(BoundedActor):
+#     def run(self):
+#         while True:
+#             print("Got:", self.recv())
 #
-# from threading import Event
-# class Result:
-#     def __init__(self):
-#         self._evt = Event()
-#         self._result = None
+# p = BoundedPrintActor(maxsize=100, policy=DROP_OLDEST)
+# p.start()
+# for i in range(1000):
+#     p.send(i)
+# p.close()
+# p.join()
+# print(p.metrics())
 #
-#     def set_result(self, value):
-#         self._result = value
+# 下面的测试让一个生产者尽可能快地给一个每条消息要处理1毫秒的actor发送1KB的消息，每秒打印
+# 一次tracemalloc统计的内存。maxsize=0（无界）时内存会一直增长，有界的邮箱内存保持不变。
+# 因为actor线程在测试结束后不会退出，每种配置最好在单独的进程中运行：
+class _SlowActor(BoundedActor):
+    def run(self):
+        while True:
+            self.recv()
+            time.sleep(0.001)
+
+
+def soak_mailbox(maxsize=1000, policy=DROP_OLDEST, duration=10, payload=1024):
+    import tracemalloc
+    tracemalloc.start()
+    actor = _SlowActor(maxsize, policy)
+    actor.start()
+    start = time.monotonic()
+    next_report = start + 1
+    while True:
+        actor.send(bytes(payload))
+        now = time.monotonic()
+        if now >= next_report:
+            m = actor.metrics()
+            print("{:4.0f}s  memory {:10.0f} KiB  depth {:8d}  dropped {:8d}".format(
+                now - start, tracemalloc.get_traced_memory()[0] / 1024,
+                m["depth"], m["dropped"]))
+            next_report += 1
+            if now - start >= duration:
+                break
+    tracemalloc.stop()
+
+# soak_mailbox(maxsize=0)
+# soak_mailbox(maxsize=1000, policy=DROP_OLDEST)
+# soak_mailbox(maxsize=1000, policy=BLOCK)
+# 无界邮箱的结果（5秒）：
+#    1s  memory      48603 KiB  depth    43450  dropped        0
+#    3s  memory     129873 KiB  depth   116116  dropped        0
+#    5s  memory     205344 KiB  depth   183597  dropped        0
+# maxsize=1000, policy=DROP_OLDEST：
+#    1s  memory       1126 KiB  depth     1000  dropped    47869
+#    3s  memory       1126 KiB  depth     1000  dropped   145817
+#    5s  memory       1126 KiB  depth     1000  dropped   241349
+# policy=BLOCK时内存同样不变，只是生产者被限制在actor的处理速度上。
+
+
+# 扩展：共享邮箱的actor池
+# Worker 在一个线程中执行所有提交的函数。要让它随负载伸缩，可以启动多个相同的actor，让它们
+# 从同一个邮箱中取消息，谁空闲谁就处理下一条。ActorPool 还会启动一个监视线程，定期检查邮箱
+# 的深度和消息的平均等待时间：积压太多或者等待太久时增加一个actor（不超过max_workers），
+# 邮箱连续一段时间为空时关闭一个actor（不少于min_workers）。关闭的方式就是往邮箱里放一个
+# ActorExit ，哪个actor拿到它哪个就退出：
+import os
+
+
+class ActorPool:
+    def __init__(self, actor_class, *args, min_workers=1, max_workers=os.cpu_count(),
+                 maxsize=0, policy=BLOCK, interval=0.1, scale_up_depth=10,
+                 target_latency=0.05, idle_intervals=10, **kwargs):
+        self.actor_class = actor_class
+        self.args = args
+        self.kwargs = kwargs
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.scale_up_depth = scale_up_depth  # 平均每个actor积压多少条消息时扩容
+        self.target_latency = target_latency  # 消息平均等待多少秒时扩容
+        self.idle_intervals = idle_intervals  # 邮箱连续为空多少个周期后缩容
+        self._mailbox = Mailbox(maxsize, policy)
+        self._actors = []
+        self._lock = Lock()
+        self._closed = Event()
+
+    def _spawn(self):
+        actor = self.actor_class(*self.args, **self.kwargs)
+        actor._mailbox = self._mailbox
+        actor.start()
+        self._actors.append(actor)
+
+    def _live_actors(self):
+        self._actors = [a for a in self._actors if not a._terminated.is_set()]
+        return len(self._actors)
+
+    def start(self):
+        for _ in range(self.min_workers):
+            self._spawn()
+        t = Thread(target=self._monitor)
+        t.daemon = True
+        t.start()
+
+    def _monitor(self):
+        last = self._mailbox.metrics()
+        idle = 0
+        while not self._closed.wait(self.interval):
+            m = self._mailbox.metrics()
+            received = m["received"] - last["received"]
+            latency = (m["wait_time"] - last["wait_time"]) / received if received else 0.0
+            last = m
+            with self._lock:
+                if self._closed.is_set():
+                    break
+                n = self._live_actors()
+                if n < self.max_workers and (m["depth"] > n * self.scale_up_depth or
+                                             latency > self.target_latency):
+                    self._spawn()
+                    idle = 0
+                elif m["depth"] == 0:
+                    idle += 1
+                    if idle >= self.idle_intervals and n > self.min_workers:
+                        self._mailbox.put(ActorExit, force=True)
+                        idle = 0
+                else:
+                    idle = 0
+
+    def send(self, msg):
+        self._mailbox.put(msg)
+
+    def try_send(self, msg):
+        return self._mailbox.put(msg, nowait=True)
+
+    def submit(self, func, *args, **kwargs):
+        """actor_class是Worker或者它的子类时使用"""
+        r = Result()
+        self.send((func, args, kwargs, r))
+        return r
+
+    @property
+    def workers(self):
+        with self._lock:
+            return self._live_actors()
+
+    def metrics(self):
+        m = self._mailbox.metrics()
+        m["workers"] = self.workers
+        return m
+
+    def close(self):
+        """让所有actor处理完邮箱中的消息后退出"""
+        with self._lock:
+            self._closed.set()
+            for _ in range(self._live_actors()):
+                self._mailbox.put(ActorExit, force=True)
+
+    def join(self):
+        for actor in list(self._actors):
+            actor.join()
+
+
+# 对于CPU密集型的函数，线程受到GIL的限制。ProcessWorker 把函数交给一个进程池执行，
+# actor线程只是等待结果（函数和参数必须能被pickle序列化）：
+from concurrent.futures import ProcessPoolExecutor
+
+
+class ProcessWorker(Worker):
+    def __init__(self, executor):
+        super().__init__()
+        self.executor = executor
+
+    def run(self):
+        while True:
+            func, args, kwargs, r = self.recv()
+            r.set_result(self.executor.submit(func, *args, **kwargs).result())
+
+
+# Example use
+# pool = ActorPool(Worker, min_workers=2, max_workers=16)
+# pool.start()
+# r = pool.submit(pow, 2, 3)
+# print(r.result())
+# pool.close()
+# pool.join()
 #
-#         self._evt.set()
+# executor = ProcessPoolExecutor(4)
+# pool = ActorPool(ProcessWorker, executor, min_workers=4, max_workers=4)
 #
-#     def result(self):
-#         self._evt.wait()
-#         return self._result
+# 下面的基准测试提交njobs个阻塞1毫秒的函数（模拟I/O），比较不同数量的actor的吞吐量，
+# 最后一行是从1个actor开始自动扩容的结果：
+def bench_actor_pool(workers=(1, 2, 4, 8, 16), njobs=2000, delay=0.001):
+    def run(pool):
+        pool.start()
+        start = time.perf_counter()
+        results = [pool.submit(time.sleep, delay) for _ in range(njobs)]
+        for r in results:
+            r.result()
+        elapsed = time.perf_counter() - start
+        nworkers = pool.workers
+        pool.close()
+        pool.join()
+        return njobs / elapsed, nworkers
+
+    for n in workers:
+        rate, _ = run(ActorPool(Worker, min_workers=n, max_workers=n))
+        print("{:3d} workers          {:8.0f} jobs/s".format(n, rate))
+    rate, n = run(ActorPool(Worker, min_workers=1, max_workers=max(workers)))
+    print("auto (ended with {:2d}) {:8.0f} jobs/s".format(n, rate))
+
+# bench_actor_pool()
+#   1 workers               718 jobs/s
+#   2 workers              1365 jobs/s
+#   4 workers              2679 jobs/s
+#   8 workers              4333 jobs/s
+#  16 workers              7557 jobs/s
+# auto (ended with  8)     2455 jobs/s
+# 监视线程每个周期最多增加一个actor，所以自动扩容需要一点时间才能跟上突发的负载。
+
+
+# 扩展：更轻量的Result
+# 每次 Worker.submit() 都会创建一个 Result ，而它里面的 Event 又包含一个 Condition 和一个
+# Lock ，Condition 内部还有一个deque。每秒几十万次提交时，这些对象的创建和销毁开销很可观。
 #
-# class Worker(Actor):
-#     def submit(self, func, *args, **kwargs):
-#         r = Result()
-#         self.send((func, args, kwargs, r))
-#         return r
+# 其实等待一个结果只需要一个锁：创建时先获取它，设置结果时释放它，等待的线程获取到锁就
+# 说明结果已经设置好了（获取之后马上释放，让其他等待的线程也能通过）。再加上 __slots__ ，
+# 一个 Future 只需要一个锁对象、一个回调函数列表和它自己。
 #
+# 设置结果时不需要任何共享的锁：_finish() 先设置 _done 再检查回调函数列表，
+# add_done_callback() 先把回调函数放进列表再检查 _done ，两者至少有一个会看到对方。
+# 回调函数用 list.pop() 取出（在GIL下是原子的），所以即使两边同时执行，每个回调函数也只会
+# 被调用一次：
+import sys
+
+
+class Future:
+    __slots__ = ("_latch", "_done", "_result", "_exception", "_callbacks")
+
+    def __init__(self):
+        self._latch = Lock()
+        self._latch.acquire()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def _finish(self):
+        self._done = True
+        self._latch.release()
+        if self._callbacks:
+            self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks = self._callbacks
+        while True:
+            try:
+                fn = callbacks.pop(0)
+            except IndexError:
+                return
+            fn(self)
+
+    def set_result(self, value):
+        self._result = value
+        self._finish()
+
+    def set_exception(self, exc):
+        self._exception = exc
+        self._finish()
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        if not self._done:
+            if not self._latch.acquire(timeout=-1 if timeout is None else timeout):
+                raise TimeoutError
+            self._latch.release()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, fn):
+        """结果设置好之后调用fn(future)，如果已经设置好了就马上调用"""
+        self._callbacks.append(fn)
+        if self._done:
+            self._run_callbacks()
+
+    def then(self, fn):
+        """返回一个新的Future，它的结果是fn(这个Future的结果)"""
+        future = Future()
+
+        def chain(f):
+            try:
+                future.set_result(fn(f.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.add_done_callback(chain)
+        return future
+
+
+def as_completed(futures, timeout=None):
+    """按完成的顺序返回futures"""
+    from queue import SimpleQueue, Empty
+    futures = list(futures)
+    done = SimpleQueue()
+    for f in futures:
+        f.add_done_callback(done.put)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for _ in futures:
+        try:
+            yield done.get(timeout=None if deadline is None else
+                           max(0, deadline - time.monotonic()))
+        except Empty:
+            raise TimeoutError
+
+
+def gather(futures, timeout=None):
+    """等待所有futures，按顺序返回它们的结果"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    return [f.result(None if deadline is None else max(0, deadline - time.monotonic()))
+            for f in futures]
+
+
+# FastWorker 使用 Future 返回结果，函数抛出的异常也会被传给 Future 而不是让actor退出。
+# submit_many() 把一批调用放在一个列表中，只需要一次邮箱操作：
+class FastWorker(Worker):
+    def submit(self, func, *args, **kwargs):
+        f = Future()
+        self.send((func, args, kwargs, f))
+        return f
+
+    def submit_many(self, calls):
+        """calls是(func, args, kwargs)的序列，返回对应的Future列表"""
+        jobs = [(func, args, kwargs, Future()) for func, args, kwargs in calls]
+        self.send(jobs)
+        return [job[3] for job in jobs]
+
+    def run(self):
+        while True:
+            msg = self.recv()
+            for func, args, kwargs, f in (msg if type(msg) is list else (msg,)):
+                try:
+                    f.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    f.set_exception(e)
+
+
+# Example use
+# worker = FastWorker()
+# worker.start()
+# f = worker.submit(pow, 2, 3).then(lambda r: r * 10)
+# print(f.result(timeout=1))
+# fs = worker.submit_many([(pow, (2, n), {}) for n in range(10)])
+# print(gather(fs))
+# for f in as_completed(fs):
+#     print(f.result())
+#
+# 下面的基准测试比较每个结果对象占用的内存块数，以及提交njobs个pow()并等待全部完成的速度：
+def bench_futures(njobs=200000, batch=1000):
+    for cls in (Result, Future):
+        objs = []
+        before = sys.getallocatedblocks()
+        for _ in range(10000):
+            objs.append(cls())
+        print("{:8s} {:6.1f} blocks each".format(
+            cls.__name__, (sys.getallocatedblocks() - before) / 10000))
+        del objs
+
+    def run(name, worker, submit):
+        worker.start()
+        start = time.perf_counter()
+        results = submit(worker)
+        for r in results:
+            r.result()
+        elapsed = time.perf_counter() - start
+        worker.close()
+        worker.join()
+        print("{:28s} {:10.0f} submits/s".format(name, njobs / elapsed))
+
+    run("Worker.submit", Worker(),
+        lambda w: [w.submit(pow, n, 2) for n in range(njobs)])
+    run("FastWorker.submit", FastWorker(),
+        lambda w: [w.submit(pow, n, 2) for n in range(njobs)])
+    run("FastWorker.submit_many", FastWorker(),
+        lambda w: [f for i in range(0, njobs, batch) for f in
+                   w.submit_many([(pow, (n, 2), {}) for n in range(i, i + batch)])])
+
+# bench_futures()
+# Result     11.0 blocks each
+# Future      3.0 blocks each
+# Worker.submit                     46995 submits/s
+# FastWorker.submit                 99140 submits/s
+# FastWorker.submit_many           173689 submits/s
+
+
+# 扩展：跨进程的actor
+# 前面提到 send() 可以通过套接字发送消息。下面用11.7小节介绍的 multiprocessing.connection
+# 来实现：serve_actor() 在一个进程中托管一个actor，把从连接上收到的消息交给它的 send() ；
+# RemoteActor 是另一个进程中的代理，它的 send() 把消息序列化后发送出去。actor之间的通信
+# 本来就是单向异步的，所以发送者不需要等待任何回应，可以连续地发送（流水线）。RemoteActor
+# 还会把多个消息攒成一批放在一个帧里发送，批满了或者过了linger秒就发送一次。
+#
+# 使用pickle协议5时，像bytearray、numpy数组这样支持缓冲区协议的大对象会作为带外缓冲区
+# 单独发送，不需要先复制进pickle的字节串中：
+import pickle
+import struct
+from multiprocessing.connection import Listener, Client
+
+
+def _send_frame(conn, msgs, protocol):
+    buffers = []
+    if protocol >= 5:
+        data = pickle.dumps(msgs, protocol, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(msgs, protocol)
+    # 帧的开头是带外缓冲区的数量，缓冲区紧跟在后面
+    conn.send_bytes(struct.pack("!I", len(buffers)) + data)
+    for buf in buffers:
+        conn.send_bytes(buf.raw())
+
+
+def _recv_frame(conn):
+    frame = conn.recv_bytes()
+    nbuffers, = struct.unpack_from("!I", frame)
+    buffers = [conn.recv_bytes() for _ in range(nbuffers)]
+    return pickle.loads(memoryview(frame)[4:], buffers=buffers)
+
+
+def _actor_connection(actor, conn):
+    try:
+        while True:
+            for msg in _recv_frame(conn):
+                actor.send(msg)
+    except EOFError:
+        pass
+    finally:
+        conn.close()
+
+
+def serve_actor(actor, address, authkey):
+    """接受RemoteActor的连接，把收到的消息发送给actor"""
+    serv = Listener(address, authkey=authkey)
+    while True:
+        conn = serv.accept()
+        t = Thread(target=_actor_connection, args=(actor, conn))
+        t.daemon = True
+        t.start()
+
+
+class RemoteActor:
+    def __init__(self, address, authkey, batch_size=128, linger=0.01,
+                 protocol=pickle.HIGHEST_PROTOCOL):
+        self._conn = Client(address, authkey=authkey)
+        self.batch_size = batch_size
+        self.protocol = protocol
+        self._pending = []
+        self._lock = Lock()
+        self._closed = Event()
+        if linger:
+            t = Thread(target=self._flusher, args=(linger,))
+            t.daemon = True
+            t.start()
+
+    def _flusher(self, linger):
+        while not self._closed.wait(linger):
+            self.flush()
+
+    def send(self, msg):
+        """发送一个消息给远程的actor"""
+        with self._lock:
+            self._pending.append(msg)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            msgs, self._pending = self._pending, []
+            _send_frame(self._conn, msgs, self.protocol)
+
+    def flush(self):
+        with self._lock:
+            if not self._closed.is_set():
+                self._flush()
+
+    def close(self):
+        """发送剩下的消息并关闭连接，远程的actor不会被关闭"""
+        with self._lock:
+            self._closed.set()
+            self._flush()
+            self._conn.close()
+
+
+# Example use
+# 在一个进程中：
+# p = PrintActor()
+# p.start()
+# serve_actor(p, ("", 17001), authkey=b"peekaboo")
+#
+# 在另一个进程中：
+# p = RemoteActor(("localhost", 17001), authkey=b"peekaboo")
+# p.send("Hello")
+# p.send("World")
+# p.close()
+#
+# 下面的基准测试比较本地actor和远程actor每秒能处理多少消息。远程的actor在一个fork出来的进程
+# 中运行，收到nmsgs个消息后退出：
+class _CountingActor(Actor):
+    def __init__(self, nmsgs):
+        super().__init__()
+        self.nmsgs = nmsgs
+
+    def run(self):
+        for _ in range(self.nmsgs):
+            self.recv()
+
+
+def bench_remote_actor(nmsgs=200000, nlarge=200, large=1 << 20,
+                       address=("127.0.0.1", 17100), authkey=b"peekaboo"):
+    import multiprocessing
+
+    actor = _CountingActor(nmsgs)
+    actor.start()
+    start = time.perf_counter()
+    for i in range(nmsgs):
+        actor.send(i)
+    actor.join()
+    print("{:32s} {:10.0f} msgs/s".format("local", nmsgs / (time.perf_counter() - start)))
+
+    def host(n):
+        actor = _CountingActor(n)
+        actor.start()
+        t = Thread(target=serve_actor, args=(actor, address, authkey))
+        t.daemon = True
+        t.start()
+        actor.join()
+
+    def remote(name, n, msg, **kwargs):
+        p = multiprocessing.get_context("fork").Process(target=host, args=(n,))
+        p.start()
+        while True:
+            try:
+                r = RemoteActor(address, authkey, **kwargs)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        start = time.perf_counter()
+        for _ in range(n):
+            r.send(msg)
+        r.flush()
+        p.join()
+        elapsed = time.perf_counter() - start
+        r.close()
+        print("{:32s} {:10.0f} msgs/s {:8.1f} MiB/s".format(
+            name, n / elapsed, n * len(msg) / elapsed / (1 << 20)))
+
+    remote("remote batch_size=1", nmsgs, b"x", batch_size=1)
+    remote("remote batch_size=128", nmsgs, b"x", batch_size=128)
+    payload = bytearray(large)
+    remote("1MiB bytearray protocol 4", nlarge, payload, batch_size=1, protocol=4)
+    remote("1MiB bytearray protocol 5", nlarge, payload, batch_size=1, protocol=5)
+
+# bench_remote_actor()
+# local                                242234 msgs/s
+# remote batch_size=1                   44573 msgs/s      0.0 MiB/s
+# remote batch_size=128                189168 msgs/s      0.2 MiB/s
+# 1MiB bytearray protocol 4               213 msgs/s    213.3 MiB/s
+# 1MiB bytearray protocol 5               291 msgs/s    290.6 MiB/s
+
+
+# 扩展：监督者和重启策略
+# 如果 run() 抛出了 ActorExit 以外的异常，线程就结束了，actor连同邮箱里的消息一起悄无声息
+# 地消失。借鉴Erlang的做法，可以让一个监督者负责它的子actor：子actor出错时，_bootstrap()
+# 会通知它的 supervisor ，监督者用创建时的工厂函数重新创建一个actor，并把旧actor的邮箱
+# 交给它，所以还没有处理的消息不会丢失（只有导致出错的那一条消息没有了）。仍然持有旧actor
+# 的发送者也没有关系，它们发送的消息会进入同一个邮箱。
+#
+# 重启策略有两种：one-for-one只重启出错的actor；one-for-all先把其他子actor也停下来，然后
+# 全部重启，适合互相依赖的一组actor。已经被所有者 close() 的actor出错时当作已经停止，不会
+# 被重启。如果在period秒内重启超过max_restarts次，说明问题不是重启能解决的，监督者会停止
+# 所有子actor并抛出 TooManyRestarts 。监督者本身也是一个actor，所以它也可以被另一个监督者
+# 监督，这样就构成了一棵监督树：
+ONE_FOR_ONE = "one-for-one"
+ONE_FOR_ALL = "one-for-all"
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+class Supervisor(Actor):
+    def __init__(self, strategy=ONE_FOR_ONE, max_restarts=3, period=5.0):
+        super().__init__()
+        self.strategy = strategy
+        self.max_restarts = max_restarts
+        self.period = period
+        self.restarts = 0
+        self._restart_times = deque()
+        self._children = {}  # name -> [factory, actor]
+
+    def start_child(self, name, factory):
+        """用factory()创建一个子actor并启动它"""
+        actor = factory()
+        if not isinstance(actor._mailbox, Mailbox):
+            actor._mailbox = Mailbox()  # 需要能把ActorExit放到最前面
+        actor.supervisor = self
+        self._children[name] = [factory, actor]
+        actor.start()
+        return actor
+
+    def child(self, name):
+        """返回名字对应的当前正在运行的actor"""
+        return self._children[name][1]
+
+    def child_failed(self, actor, exc):
+        # 在出错的actor的线程中被调用，交给监督者自己的线程处理
+        actor._crashed = True
+        self.send((actor, exc))
+
+    def _restart(self, name, stopped=False):
+        factory, old = self._children[name]
+        old.join()
+        # 监督者插到最前面的ActorExit，如果旧actor在读到它之前就出错退出了，它还在邮箱的
+        # 最前面，新actor读到它就会退出。其他的ActorExit是所有者调用close()放进去的，不能删
+        crashed = getattr(old, "_crashed", False)
+        if stopped and crashed:
+            old._mailbox.remove_front(ActorExit)
+        if ActorExit in old._mailbox or not (stopped or crashed):
+            # 所有者已经关闭了它（或者已经正常退出了），当作正常停止，不再重启
+            del self._children[name]
+            return
+        actor = factory()
+        actor._mailbox = old._mailbox  # 保留还没有处理的消息
+        actor.supervisor = self
+        self._children[name][1] = actor
+        actor.start()
+
+    def _check_intensity(self):
+        now = time.monotonic()
+        self._restart_times.append(now)
+        while self._restart_times[0] < now - self.period:
+            self._restart_times.popleft()
+        if len(self._restart_times) > self.max_restarts:
+            raise TooManyRestarts("more than {} restarts in {} seconds".format(
+                self.max_restarts, self.period))
+
+    def run(self):
+        try:
+            while True:
+                actor, exc = self.recv()
+                names = [name for name, (_, a) in self._children.items() if a is actor]
+                if not names:
+                    continue  # 已经被重启过了
+                self._check_intensity()
+                stopped = set()  # 被监督者插入了ActorExit的子actor
+                if self.strategy == ONE_FOR_ALL:
+                    for name, (_, a) in self._children.items():
+                        # 已经出错退出的actor（它的失败通知还在排队）不需要再停止
+                        if a is not actor and not a._terminated.is_set():
+                            # 插到邮箱最前面，让它马上停下来，剩下的消息留给重启后的actor
+                            a._mailbox.put(ActorExit, force=True, front=True)
+                            stopped.add(name)
+                            a.join()
+                    names = list(self._children)
+                for name in names:
+                    self._restart(name, name in stopped)
+                self.restarts += 1
+        finally:
+            for _, actor in self._children.values():
+                actor.close()
+            for _, actor in self._children.values():
+                actor.join()
+
+
+# Example use
+# class Divider(Actor):
 #     def run(self):
 #         while True:
-#             func, args, kwargs, r = self.recv()
-#             r.set_result(func(*args, **kwargs))
+#             x = self.recv()
+#             print("Got:", 1 / x)
 #
-# # Example use
-# worker = Worker()
-# worker.start()
-# r = worker.submit(pow, 2, 3)
-# print(r.result())
-# 最后，“发送”一个任务消息的概念可以被扩展到多进程甚至是大型分布式系统中去。 例如，
-# 一个类actor对象的 send() 方法可以被编程让它能在一个套接字连接上传输数据 或通过某
-# 些消息中间件（比如AMQP、ZMQ等）来发送。
+# sup = Supervisor(ONE_FOR_ONE, max_restarts=10, period=1)
+# sup.start()
+# d = sup.start_child("divider", Divider)
+# for x in [1, 0, 2, 0, 4]:
+#     d.send(x)          # 除以0时Divider被重启，后面的消息照样处理
+# sup.close()
+# sup.join()
+#
+# 下面的基准测试每nnormal个普通消息之间插入一个会让actor出错的消息，测量从抛出异常到新的
+# actor开始运行的时间，以及普通消息有没有丢失：
+class _CrashyActor(Actor):
+    processed = 0
+    failed_at = None
+    latencies = []
+
+    def run(self):
+        cls = _CrashyActor
+        if cls.failed_at is not None:
+            cls.latencies.append(time.perf_counter() - cls.failed_at)
+            cls.failed_at = None
+        while True:
+            msg = self.recv()
+            if msg == "boom":
+                cls.failed_at = time.perf_counter()
+                raise RuntimeError("injected fault")
+            cls.processed += 1
+
 
+def bench_supervisor(nfaults=1000, nnormal=100, strategy=ONE_FOR_ONE):
+    _CrashyActor.processed = 0
+    _CrashyActor.latencies = []
+    sup = Supervisor(strategy, max_restarts=nfaults + 1, period=60)
+    sup.start()
+    actor = sup.start_child("crashy", _CrashyActor)
+    sent = 0
+    for _ in range(nfaults):
+        for _ in range(nnormal):
+            actor.send(sent)
+            sent += 1
+        actor.send("boom")
+    deadline = time.monotonic() + 60
+    while _CrashyActor.processed < sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sup.close()
+    sup.join()
+    latencies = sorted(_CrashyActor.latencies)
+    print("{} restarts, restart latency p50 {:.1f} us p99 {:.1f} us, lost {} of {} messages".format(
+        sup.restarts, latencies[len(latencies) // 2] * 1e6,
+        latencies[len(latencies) * 99 // 100] * 1e6, sent - _CrashyActor.processed, sent))
 
+# 在单核的测试机器上：1000次重启，重启延迟p50约190us、p99约630us，100000个普通消息没有丢失
+# bench_supervisor()
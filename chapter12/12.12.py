@@ -171,21 +171,24 @@ class Scheduler:
     def _write_wait(self, fileno, evt, task):
         self._write_waiting[fileno] = (evt, task)
 
+    def _step(self, task, msg):
+        try:
+            # 运行协程到下一个yield
+            r = task.send(msg)
+            if isinstance(r, YieldEvent):
+                r.handle_yield(self, task)
+            else:
+                raise RuntimeError("unrecognized yield event")
+        except StopIteration:
+            self._numtasks -= 1
+
     def run(self):
         """运行一个任务调度器直到没有任务"""
         while self._numtasks:
             if not self._ready:
                 self._iopoll()
             task, msg = self._ready.popleft()
-            try:
-                # 运行协程到下一个yield
-                r = task.send(msg)
-                if isinstance(r, YieldEvent):
-                    r.handle_yield(self, task)
-                else:
-                    raise RuntimeError("unrecognized yield event")
-            except StopIteration:
-                self._numtasks -= 1
+            self._step(task, msg)
 
 
 # 基于协程实现的socket I/O
@@ -233,7 +236,7 @@ class Socket(object):
         self._sock = sock
 
     def recv(self, maxbytes):
-        return ReadSocket(sock, maxbytes)
+        return ReadSocket(self._sock, maxbytes)
 
     def send(self, data):
         return WriteSocket(self._sock, data)
@@ -245,50 +248,124 @@ class Socket(object):
         return getattr(self._sock, name)
 
 
-if __name__ == "__main__":
-    from socket import socket, AF_INET, SOCK_STREAM
-    import time
+# 涉及生成器的函数，这应该这样调用：
+# line = yield from readline(sock)
+def readline(sock):
+    chars = []
+    while True:
+        c = yield sock.recv(1)
+        if not c:
+            break
+        chars.append(c)
+        if c == b"\n":
+            break
+    return b"".join(chars)
+
+
+# 上面的 readline() 每读一个字节都要yield一次，也就是每个字节都要经过一次调度和一次
+# recv()系统调用。更好的做法是一次读取一大块数据放进缓冲区，然后在缓冲区里查找需要的数据，
+# 只有缓冲区里的数据不够时才yield：
+class StreamReader:
+    def __init__(self, sock, chunk_size=65536):
+        self._sock = sock  # Socket包装对象
+        self.chunk_size = chunk_size
+        self._buf = bytearray()
+        self._eof = False
+
+    def _fill(self):
+        data = yield self._sock.recv(self.chunk_size)
+        if data:
+            self._buf.extend(data)
+        else:
+            self._eof = True
+
+    def _take(self, n):
+        data = bytes(self._buf[:n])
+        del self._buf[:n]  # 删除bytearray开头的数据不需要移动剩下的数据
+        return data
+
+    def read(self, n):
+        """读取最多n个字节，返回b""表示连接已关闭"""
+        if not self._buf and not self._eof:
+            yield from self._fill()
+        return self._take(n)
+
+    def readexactly(self, n):
+        """读取正好n个字节"""
+        while len(self._buf) < n:
+            if self._eof:
+                raise EOFError("expected {} bytes, got {}".format(n, len(self._buf)))
+            yield from self._fill()
+        return self._take(n)
+
+    def readuntil(self, sep=b"\n"):
+        """读取到sep为止（包括sep）"""
+        start = 0
+        while True:
+            i = self._buf.find(sep, start)
+            if i >= 0:
+                return self._take(i + len(sep))
+            if self._eof:
+                raise EOFError("separator {!r} not found".format(sep))
+            # 下次只需要从新数据（以及可能跨块的分隔符）开始查找
+            start = max(0, len(self._buf) - len(sep) + 1)
+            yield from self._fill()
+
+    def readline(self):
+        """跟readline()一样，连接关闭时返回剩下的数据，没有数据时返回空字节串"""
+        try:
+            return (yield from self.readuntil(b"\n"))
+        except EOFError:
+            return self._take(len(self._buf))
+
+
+class StreamWriter:
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = bytearray()
 
-    # 涉及生成器的函数，这应该这样调用：
-    # line = yield from readline(sock)
-    def readline(sock):
-        chars = []
+    def write(self, data):
+        """只是放进缓冲区，需要调用drain()才会真正发送"""
+        self._buf.extend(data)
+
+    def drain(self):
+        while self._buf:
+            nsent = yield self._sock.send(self._buf)
+            del self._buf[:nsent]
+
+
+from socket import socket, AF_INET, SOCK_STREAM
+
+
+# 使用协程的Echo server
+class EchoServer:
+    def __init__(self, addr, sched):
+        self.sched = sched
+        sched.new(self.server_loop(addr))
+
+    def server_loop(self, addr):
+        s = Socket(socket(AF_INET, SOCK_STREAM))
+        s.bind(addr)
+        s.listen(5)
         while True:
-            c = yield sock.recv(1)
-            if not c:
-                break
-            chars.append(c)
-            if c == b"\n":
+            c, a = yield s.accept()
+            print("Got connection from ", a)
+            self.sched.new(self.client_handler(Socket(c)))
+
+    def client_handler(self, client):
+        while True:
+            line = yield from readline(client)
+            if not line:
                 break
-        return b"".join(chars)
-
-    # 使用协程的Echo server
-    class EchoServer:
-        def __init__(self, addr, sched):
-            self.sched = sched
-            sched.new(self.server_loop(addr))
-
-        def server_loop(self, addr):
-            s = Socket(socket(AF_INET, SOCK_STREAM))
-            s.bind(addr)
-            s.listen(5)
-            while True:
-                c, a = yield s.accept()
-                print("Got connection from ", a)
-                self.sched.new(self.client_handler(Socket(c)))
+            line = b"GOT:" + line
+            while line:
+                nsent = yield client.send(line)
+                line = line[nsent:]
+        client.close()
+        print("Client closed")
 
-        def client_handler(self, client):
-            while True:
-                line = yield from readline(client)
-                if not line:
-                    break
-                line = b"GOT:" + line
-                while line:
-                    nsent = yield client.send(line)
-                    line = line[nsent:]
-            client.close()
-            print("Client closed")
 
+if __name__ == "__main__":
     sched = Scheduler()
     EchoServer(("", 16000), sched)
     sched.run()
@@ -339,3 +416,915 @@ if __name__ == "__main__":
 # 协程调度器。 不过，关于协程的思想是很多流行库的基础， 包括 gevent, greenlet,
 # Stackless Python 以及其他类似工程。
 
+
+# 扩展：带缓冲的读写
+# 前面定义的 StreamReader 和 StreamWriter 可以代替逐字节的 readline() ，每次系统调用
+# 读取一大块数据，在缓冲区中查找换行符。EchoServer 的 client_handler() 可以改写成这样：
+#
+#     def client_handler(self, client):
+#         reader = StreamReader(client)
+#         writer = StreamWriter(client)
+#         while True:
+#             line = yield from reader.readline()
+#             if not line:
+#                 break
+#             writer.write(b"GOT:" + line)
+#             yield from writer.drain()
+#         client.close()
+#
+# 下面的基准测试用一个线程往socket里写入nlines行数据，比较两种方式每秒能读取多少行：
+def bench_readline(nlines=20000, linelen=64):
+    from socket import socketpair
+    from threading import Thread
+
+    payload = (b"x" * (linelen - 1) + b"\n") * nlines
+
+    def per_byte(sock, counter):
+        while (yield from readline(sock)):
+            counter[0] += 1
+
+    def buffered(sock, counter):
+        reader = StreamReader(sock)
+        while (yield from reader.readline()):
+            counter[0] += 1
+
+    for task in (per_byte, buffered):
+        a, b = socketpair()
+        counter = [0]
+        sched = Scheduler()
+        sched.new(task(Socket(a), counter))
+        t = Thread(target=lambda: (b.sendall(payload), b.close()))
+        start = time.perf_counter()
+        t.start()
+        sched.run()
+        elapsed = time.perf_counter() - start
+        t.join()
+        a.close()
+        print("{:10s} {:10.0f} lines/s".format(task.__name__, counter[0] / elapsed))
+
+# bench_readline()
+# per_byte         2539 lines/s
+# buffered       589830 lines/s
+# 逐字节读取时，每个字节都要经过一次select()、一次recv()和一次生成器切换。
+
+
+# 扩展：使用selectors和定时器的调度器
+# Scheduler 有几个问题：每次 _iopoll() 都要把整个等待字典交给 select() ，超过1024个fd
+# 就不能用了；每个fd在每个方向上只能有一个任务等待，后来的会覆盖前面的；只有在就绪队列为空
+# 时才会检查I/O，忙碌的任务会让等待I/O的任务饿死；而且任务没有办法休眠一段时间。
+#
+# 下面的调度器使用 selectors 模块，fd关注的事件只在发生变化时才修改，而且这些修改会被推迟
+# 到下一次轮询之前统一处理，这样一个不断读取的任务不需要每次都注销再重新注册。每执行
+# poll_interval个任务就用0超时轮询一次I/O。休眠的任务放在一个按唤醒时间排序的堆里：
+import heapq
+import itertools
+import selectors
+import time
+
+
+class _Waiters:
+    def __init__(self, sock):
+        self.sock = sock  # 用于检测fd是否已经被关闭并重新分配
+        self.events = 0  # 当前在selector中注册的事件
+        self.readers = deque()
+        self.writers = deque()
+
+
+class SelectorScheduler(Scheduler):
+    def __init__(self, poll_interval=64):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._waiting = {}  # fd -> _Waiters
+        self._dirty = set()  # 关注的事件可能需要修改的fd
+        self._sleeping = []  # (唤醒时间, 序号, 任务)
+        self._seq = itertools.count()
+
+    def _waiters(self, fileno, evt):
+        sock = getattr(evt, "sock", None)
+        w = self._waiting.get(fileno)
+        if w is not None and w.sock is not sock:
+            # 原来的socket已经被关闭，内核也已经删除了它的注册，fd被分配给了新的socket
+            if w.events:
+                self._selector.unregister(fileno)
+            w = None
+        if w is None:
+            w = self._waiting[fileno] = _Waiters(sock)
+        self._dirty.add(fileno)
+        return w
+
+    def _read_wait(self, fileno, evt, task):
+        self._waiters(fileno, evt).readers.append((evt, task))
+
+    def _write_wait(self, fileno, evt, task):
+        self._waiters(fileno, evt).writers.append((evt, task))
+
+    def _sleep(self, seconds, task):
+        heapq.heappush(self._sleeping,
+                       (time.monotonic() + seconds, next(self._seq), task))
+
+    def _update_selector(self):
+        for fd in self._dirty:
+            w = self._waiting[fd]
+            events = ((selectors.EVENT_READ if w.readers else 0) |
+                      (selectors.EVENT_WRITE if w.writers else 0))
+            if events == w.events:
+                continue
+            if not w.events:
+                self._selector.register(fd, events)
+            elif not events:
+                self._selector.unregister(fd)
+            else:
+                self._selector.modify(fd, events)
+            w.events = events
+            if not events:
+                del self._waiting[fd]
+        self._dirty.clear()
+
+    def _iopoll(self, timeout=None):
+        self._update_selector()
+        for key, mask in self._selector.select(timeout):
+            w = self._waiting[key.fd]
+            # 同一个方向上有多个任务等待时，每次只唤醒一个
+            if mask & selectors.EVENT_READ and w.readers:
+                evt, task = w.readers.popleft()
+                evt.handle_resume(self, task)
+            if mask & selectors.EVENT_WRITE and w.writers:
+                evt, task = w.writers.popleft()
+                evt.handle_resume(self, task)
+            self._dirty.add(key.fd)
+
+    def _wake_sleepers(self):
+        now = time.monotonic()
+        while self._sleeping and self._sleeping[0][0] <= now:
+            _, _, task = heapq.heappop(self._sleeping)
+            self.add_ready(task)
+
+    def run(self):
+        steps = 0
+        while self._numtasks:
+            if not self._ready:
+                timeout = None
+                if self._sleeping:
+                    timeout = max(0, self._sleeping[0][0] - time.monotonic())
+                self._iopoll(timeout)
+                steps = 0
+            elif steps >= self.poll_interval:
+                # 就绪队列一直不为空时，也要定期检查I/O
+                self._iopoll(0)
+                steps = 0
+            self._wake_sleepers()
+            if self._ready:
+                task, msg = self._ready.popleft()
+                self._step(task, msg)
+                steps += 1
+
+
+class Sleep(YieldEvent):
+    """让任务休眠seconds秒，只能在SelectorScheduler中使用"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def handle_yield(self, sched, task):
+        sched._sleep(self.seconds, task)
+
+
+# 例如，下面的任务每秒打印一次：
+#
+# def ticker():
+#     while True:
+#         print("tick")
+#         yield Sleep(1)
+#
+# sched = SelectorScheduler()
+# sched.new(ticker())
+# EchoServer(("", 16000), sched)
+# sched.run()
+#
+# 下面的基准测试创建nidle个空闲的连接，每个连接都有一个任务在等待读取，同时有一对任务通过
+# 另一个连接不断地来回发送一个字节，统计每秒能完成多少次来回：
+def bench_schedulers(sizes=(100, 1000, 5000), rounds=5000):
+    from socket import socketpair
+
+    def idle(sock):
+        yield sock.recv(1)
+
+    def ping(sock, peers):
+        for _ in range(rounds):
+            yield sock.send(b"x")
+            yield sock.recv(1)
+        for peer in peers:
+            peer.close()  # 让空闲的任务读到EOF后结束
+
+    def pong(sock):
+        while (yield sock.recv(1)):
+            yield sock.send(b"x")
+
+    for n in sizes:
+        for sched_class in (Scheduler, SelectorScheduler):
+            pairs = [socketpair() for _ in range(n)]
+            a, b = socketpair()
+            sched = sched_class()
+            for x, y in pairs:
+                sched.new(idle(Socket(x)))
+            sched.new(ping(Socket(a), [a] + [y for x, y in pairs]))
+            sched.new(pong(Socket(b)))
+            start = time.perf_counter()
+            try:
+                sched.run()
+                result = "{:8.0f} round trips/s".format(
+                    rounds / (time.perf_counter() - start))
+            except ValueError as e:
+                result = str(e)
+            print("{:6d} idle  {:18s} {}".format(n, sched_class.__name__, result))
+            for x, y in pairs:
+                x.close()
+                y.close()
+            a.close()
+            b.close()
+
+# bench_schedulers()
+# 在一台单核机器上：
+#    100 idle  Scheduler             11037 round trips/s
+#    100 idle  SelectorScheduler     18031 round trips/s
+#   1000 idle  Scheduler          filedescriptor out of range in select()
+#   1000 idle  SelectorScheduler     17235 round trips/s
+#   5000 idle  Scheduler          filedescriptor out of range in select()
+#   5000 idle  SelectorScheduler     13230 round trips/s
+# 1000个空闲连接就需要2000多个fd，已经超过了select()的FD_SETSIZE（1024）。
+
+
+# 扩展：在asyncio上运行这些生成器
+# 上面的调度器做的事情跟asyncio的事件循环差不多，只是没有它用C实现的部分（或者uvloop）。
+# 已经写好的生成器任务其实不需要修改：只要把每个任务包装成一个asyncio协程，把任务yield出来
+# 的 YieldEvent 翻译成对应的 loop.sock_recv()/sock_sendall()/sock_accept() 调用，再把
+# 结果发送回生成器就可以了。AsyncioScheduler 提供跟 Scheduler 一样的 new() 和 run() ，
+# 所以可以直接传给 EchoServer ：
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class AsyncioScheduler:
+    def __init__(self, use_uvloop=True):
+        if use_uvloop and uvloop is not None:
+            self._loop = uvloop.new_event_loop()
+        else:
+            self._loop = asyncio.new_event_loop()
+        self._numtasks = 0
+        self._done = asyncio.Event()
+        self._translators = {
+            ReadSocket: self._read,
+            WriteSocket: self._write,
+            AcceptSocket: self._accept,
+            Sleep: self._sleep,
+        }
+
+    def new(self, task):
+        """添加一个新任务到调度器"""
+        self._numtasks += 1
+        self._loop.create_task(self._drive(task))
+
+    async def _drive(self, task):
+        msg = None
+        try:
+            while True:
+                try:
+                    evt = task.send(msg)
+                except StopIteration:
+                    break
+                translate = self._translators.get(type(evt))
+                if translate is None:
+                    raise RuntimeError("unrecognized yield event")
+                msg = await translate(evt)
+        finally:
+            self._numtasks -= 1
+            if not self._numtasks:
+                self._done.set()
+
+    # asyncio的sock_*方法要求socket是非阻塞的
+    async def _read(self, evt):
+        evt.sock.setblocking(False)
+        return await self._loop.sock_recv(evt.sock, evt.nbytes)
+
+    async def _write(self, evt):
+        # sock_sendall()会发送全部数据，所以直接返回数据的长度
+        evt.sock.setblocking(False)
+        await self._loop.sock_sendall(evt.sock, evt.data)
+        return len(evt.data)
+
+    async def _accept(self, evt):
+        evt.sock.setblocking(False)
+        return await self._loop.sock_accept(evt.sock)
+
+    async def _sleep(self, evt):
+        await asyncio.sleep(evt.seconds)
+
+    def run(self):
+        """运行直到没有任务"""
+        if self._numtasks:
+            self._loop.run_until_complete(self._done.wait())
+        self._loop.close()
+
+
+# 使用的时候只需要换一个调度器：
+#
+# sched = AsyncioScheduler()
+# EchoServer(("", 16000), sched)
+# sched.run()
+#
+# 下面的基准测试在子进程中分别用两种调度器运行 EchoServer ，nclients个客户端线程不断地
+# 发送一行数据并等待回显，统计每秒完成的请求数：
+def _echo_client(addr, nrequests, line=b"x" * 63 + b"\n"):
+    import socket as socketlib
+    while True:
+        try:
+            sock = socketlib.create_connection(addr)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)  # 服务器还没开始监听
+    f = sock.makefile("rb")
+    for _ in range(nrequests):
+        sock.sendall(line)
+        f.readline()
+    f.close()
+    sock.close()
+
+
+def bench_echo_schedulers(nclients=8, nrequests=2000, port=16100):
+    import multiprocessing
+    from threading import Thread
+
+    def serve(sched_class, addr):
+        sched = sched_class()
+        EchoServer(addr, sched)
+        sched.run()
+
+    ctx = multiprocessing.get_context("fork")
+    for i, sched_class in enumerate((Scheduler, SelectorScheduler, AsyncioScheduler)):
+        addr = ("127.0.0.1", port + i)
+        server = ctx.Process(target=serve, args=(sched_class, addr))
+        server.start()
+        clients = [Thread(target=_echo_client, args=(addr, nrequests))
+                   for _ in range(nclients)]
+        start = time.perf_counter()
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - start
+        server.terminate()
+        server.join()
+        print("{:18s} {:10.0f} req/s".format(sched_class.__name__,
+                                             nclients * nrequests / elapsed))
+
+# bench_echo_schedulers()
+# 没有安装uvloop，在一台单核机器上（客户端线程也在抢同一个核心）的结果：
+# Scheduler                3862 req/s
+# SelectorScheduler        2161 req/s
+# AsyncioScheduler         3686 req/s
+# EchoServer 用的是逐字节的 readline() ，大部分时间都花在生成器的切换上，三种调度器的差别
+# 不大。只有几个连接时 select() 本身很便宜，SelectorScheduler 额外的簿记反而更慢，它的优势
+# 要在连接很多的时候才能体现出来（见 bench_schedulers() ）。
+
+
+# 扩展：优先级和加权公平调度
+# 最开始的 TaskScheduler 使用一个deque轮流执行所有任务，一个对延迟敏感的任务每次都要等
+# 所有其他任务都执行一步之后才能再次运行。当有成千上万个后台任务时，这个等待时间会变得
+# 不可接受。
+#
+# 下面的调度器把任务分成几个优先级，高优先级的任务总是先执行。同一个优先级内部使用类似
+# Linux CFS的加权公平调度：记录每个任务每次 next(task) 实际花费的时间，除以权重累加到
+# 任务的虚拟运行时间上，每次选出虚拟运行时间最小的任务执行。这样权重为2的任务能获得两倍
+# 的CPU时间，而每一步很快的任务会比每一步很慢的任务更频繁地被执行：
+HIGH, NORMAL, LOW = 0, 1, 2
+
+
+class TaskInfo:
+    def __init__(self, task, name, priority, weight, budget=1):
+        self.task = task
+        self.name = name
+        self.priority = priority
+        self.weight = weight
+        self.budget = budget  # 每次被选中时最多连续执行多少步
+        self.steps = 0  # 执行了多少步
+        self.runtime = 0.0  # 总共花费的时间
+        self.vruntime = 0.0  # 虚拟运行时间
+        self.finished = False
+
+    def __repr__(self):
+        return ("TaskInfo({!r}, priority={}, weight={}, budget={}, steps={}, "
+                "runtime={:.6f})".format(self.name, self.priority, self.weight,
+                                         self.budget, self.steps, self.runtime))
+
+
+class FairTaskScheduler:
+    def __init__(self, budget=1, history=100):
+        self.budget = budget  # 任务默认每次被选中时最多连续执行多少步
+        self._queues = [[], [], []]  # 每个优先级一个堆：(虚拟运行时间, 序号, TaskInfo)
+        self._min_vruntime = [0.0, 0.0, 0.0]
+        self._seq = itertools.count()
+        self._tasks = set()  # 还没有结束的任务
+        self._finished = deque(maxlen=history)  # 最近结束的history个任务，避免无限增长
+
+    def new_task(self, task, priority=NORMAL, weight=1, name=None, budget=None):
+        """提交一个新的开始任务给调度器，budget默认使用调度器的budget"""
+        info = TaskInfo(task, name or getattr(task, "__name__", repr(task)),
+                        priority, weight, self.budget if budget is None else budget)
+        # 新任务从当前最小的虚拟运行时间开始，否则它会一直被优先执行直到追上其他任务
+        info.vruntime = self._min_vruntime[priority]
+        self._tasks.add(info)
+        self._push(info)
+        return info
+
+    def _push(self, info):
+        heapq.heappush(self._queues[info.priority],
+                       (info.vruntime, next(self._seq), info))
+
+    def stats(self):
+        """还没有结束的和最近结束的任务的运行情况，按花费的时间从多到少排序"""
+        return sorted(itertools.chain(self._tasks, self._finished),
+                      key=lambda info: info.runtime, reverse=True)
+
+    def run(self):
+        """运行任务直到没有任务"""
+        perf_counter = time.perf_counter
+        while True:
+            queue = next((q for q in self._queues if q), None)
+            if queue is None:
+                break
+            vruntime, _, info = heapq.heappop(queue)
+            self._min_vruntime[info.priority] = vruntime
+            start = perf_counter()
+            steps = 0
+            try:
+                while steps < info.budget:
+                    next(info.task)
+                    steps += 1  # 抛出StopIteration的那一次不算一步
+            except StopIteration:
+                info.finished = True
+            elapsed = perf_counter() - start
+            info.steps += steps
+            info.runtime += elapsed
+            info.vruntime += elapsed / info.weight
+            if info.finished:
+                self._tasks.discard(info)
+                self._finished.append(info)
+            else:
+                self._push(info)
+
+
+# Example use
+# sched = FairTaskScheduler()
+# sched.new_task(countdown(10), priority=HIGH)
+# sched.new_task(countdown(5))
+# sched.new_task(countup(15), priority=LOW, weight=2, budget=5)
+# sched.run()
+# print(sched.stats())
+#
+# 下面的基准测试创建nbackground个每一步都做一些计算的后台任务，再加上一个交互任务，交互任务
+# 记录自己两次被执行之间的间隔，也就是它的调度延迟：
+def bench_task_latency(nbackground=2000, nsamples=200, work=200):
+    def background():
+        while True:
+            sum(range(work))
+            yield
+
+    def interactive(gaps):
+        last = time.perf_counter()
+        for _ in range(nsamples):
+            yield
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    def report(name, gaps):
+        gaps.sort()
+        print("{:28s} p50 {:10.1f} us   p99 {:10.1f} us".format(
+            name, gaps[len(gaps) // 2] * 1e6, gaps[len(gaps) * 99 // 100] * 1e6))
+
+    # 后台任务是无限循环，交互任务结束之后让它们也停止
+    def bounded(gen, alive):
+        for _ in gen:
+            if not alive[0]:
+                return
+            yield
+
+    for name, make in (("TaskScheduler", lambda: (TaskScheduler(), {})),
+                       ("FairTaskScheduler weight=100", lambda: (FairTaskScheduler(),
+                                                                 {"weight": 100})),
+                       ("FairTaskScheduler HIGH", lambda: (FairTaskScheduler(),
+                                                           {"priority": HIGH}))):
+        sched, kwargs = make()
+        gaps = []
+        alive = [True]
+
+        def watched():
+            yield from interactive(gaps)
+            alive[0] = False
+
+        for _ in range(nbackground):
+            sched.new_task(bounded(background(), alive))
+        sched.new_task(watched(), **kwargs)
+        sched.run()
+        report(name, gaps)
+
+# bench_task_latency()
+# TaskScheduler                p50     7389.6 us   p99    16784.3 us
+# FairTaskScheduler weight=100 p50        4.0 us   p99        7.8 us
+# FairTaskScheduler HIGH       p50        2.6 us   p99       13.0 us
+# 要注意的是，如果交互任务跟后台任务的权重和优先级都一样，而每一步花费的时间也差不多，
+# 公平调度跟轮流执行的效果是一样的（还要多出维护堆的开销）。要降低延迟，必须给交互任务
+# 更高的优先级或者更大的权重。
+
+
+# 扩展：多进程分片的ActorScheduler
+# ActorScheduler 在一个线程中分发所有的消息，只能使用一个核心。下面的调度器把actor按名字的
+# 哈希值分配到nshards个工作进程中，每个进程运行自己的消息循环。发给本进程actor的消息直接
+# 放进本地队列，发给其他进程的消息被pickle序列化后写进共享内存中的环形缓冲区。每一对进程
+# 之间有一个单写单读的环形缓冲区，写的一方只修改尾指针，读的一方只修改头指针，不需要加锁。
+#
+# 注意这里依赖x86的内存模型（TSO）：写的一方先写数据再写尾指针，x86保证其他核心看到新的尾
+# 指针时也能看到之前写入的数据，读的一方同理。Python没有提供内存屏障，在ARM这样内存序更弱
+# 的机器上，另一个进程可能先看到新的尾指针，读到还没有写完的数据。要在这些机器上使用，需要
+# 用 multiprocessing.Lock 保护头、尾指针的读写（锁的获取和释放自带内存屏障）：
+import multiprocessing
+import os
+import pickle
+import struct
+import zlib
+from multiprocessing import shared_memory
+
+
+class RingBuffer:
+    """
+    共享内存中单写单读的环形缓冲区，每条记录是4字节长度加上数据
+    """
+    _WRAP = 0xFFFFFFFF  # 缓冲区末尾放不下一条记录时，写入这个标记后从头开始
+
+    def __init__(self, capacity=1 << 20):
+        self._shm = shared_memory.SharedMemory(create=True, size=16 + capacity)
+        self._capacity = capacity
+        self._index = self._shm.buf[:16].cast("Q")  # 头、尾指针，只增不减
+        self._data = self._shm.buf[16:]
+
+    def put(self, data):
+        """写入一条记录，缓冲区已满时返回False"""
+        n = len(data)
+        if n + 4 > self._capacity:
+            raise ValueError("record too large")
+        head, tail = self._index
+        pos = tail % self._capacity
+        skip = 0
+        if self._capacity - pos < n + 4:
+            skip = self._capacity - pos
+        if tail - head + skip + n + 4 > self._capacity:
+            return False
+        if skip:
+            if skip >= 4:
+                struct.pack_into("I", self._data, pos, self._WRAP)
+            tail += skip
+            pos = 0
+        struct.pack_into("I", self._data, pos, n)
+        self._data[pos + 4:pos + 4 + n] = data
+        self._index[1] = tail + n + 4  # 数据写完之后才移动尾指针
+        return True
+
+    def get(self):
+        """读出一条记录，缓冲区为空时返回None"""
+        head, tail = self._index
+        if head == tail:
+            return None
+        pos = head % self._capacity
+        if self._capacity - pos < 4 or \
+                struct.unpack_from("I", self._data, pos)[0] == self._WRAP:
+            head += self._capacity - pos
+            pos = 0
+        n = struct.unpack_from("I", self._data, pos)[0]
+        data = bytes(self._data[pos + 4:pos + 4 + n])
+        self._index[0] = head + n + 4
+        return data
+
+    def __bool__(self):
+        return self._index[0] != self._index[1]
+
+    def close(self):
+        self._index.release()
+        self._data.release()
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _shard_of(name, nshards):
+    # 不能用hash()，字符串的哈希值在不同的解释器中是不一样的
+    return zlib.crc32(name.encode("utf-8")) % nshards
+
+
+# 每个分片在共享数组中的统计信息：发送到其他分片的消息数，从其他分片收到的消息数，是否空闲，
+# 处理的消息总数
+_SENT, _RECEIVED, _IDLE, _PROCESSED = range(4)
+
+
+# 限制：没有实现工作窃取。actor是生成器对象，不能pickle，不能在进程之间传递，它的状态只存在
+# 于它所在的进程中，空闲的分片没有办法接手繁忙分片的actor；而且send()按名字的哈希值路由，
+# 把actor换到别的分片还需要一张所有进程共享的路由表。负载均衡只能依靠actor足够多、名字的
+# 哈希值分布足够均匀。如果有少数几个特别繁忙的actor，把它们拆成多个名字不同的actor：
+class ShardedActorScheduler:
+    def __init__(self, nshards=os.cpu_count(), ring_capacity=1 << 20):
+        self.nshards = nshards
+        self.ring_capacity = ring_capacity
+        self._factories = {}  # name -> (factory, args)
+        self._initial = []  # run()之前发送的消息
+        self._shard = None  # 在工作进程中是当前分片的编号
+
+    def new_actor(self, name, factory, *args):
+        """actor在它所属的工作进程中通过factory(*args)创建"""
+        self._factories[name] = (factory, args)
+
+    def send(self, name, msg):
+        """发送信息给一个actor"""
+        if self._shard is None:
+            self._initial.append((name, msg))
+            return
+        shard = _shard_of(name, self.nshards)
+        if shard == self._shard:
+            actor = self._actors.get(name)
+            if actor:
+                self._queue.append((actor, msg))
+            return
+        data = pickle.dumps((name, msg), pickle.HIGHEST_PROTOCOL)
+        while not self._outgoing[shard].put(data):
+            if self._stop.value:
+                return  # 调度器正在停止（比如对方进程已经出错退出了），缓冲区不会再被读
+            # 对方的缓冲区满了。先把发给自己的消息读进本地队列，避免两个进程互相等待
+            self._receive()
+        self._stats[self._shard * 4 + _SENT] += 1
+
+    def _receive(self):
+        received = 0
+        for ring in self._incoming:
+            while True:
+                data = ring.get()
+                if data is None:
+                    break
+                name, msg = pickle.loads(data)
+                actor = self._actors.get(name)
+                if actor:
+                    self._queue.append((actor, msg))
+                received += 1
+        self._stats[self._shard * 4 + _RECEIVED] += received
+
+    def _worker(self, shard, rings, stop):
+        self._shard = shard
+        self._stop = stop
+        self._queue = deque()
+        self._actors = {}
+        # rings[src][dst]是从src发送到dst的环形缓冲区
+        self._outgoing = rings[shard]
+        self._incoming = [rings[src][shard] for src in range(self.nshards)
+                          if src != shard]
+        for name, (factory, args) in self._factories.items():
+            if _shard_of(name, self.nshards) == shard:
+                actor = self._actors[name] = factory(*args)
+                self._queue.append((actor, None))  # 给None用于激活生成器
+        for name, msg in self._initial:
+            if _shard_of(name, self.nshards) == shard:
+                self.send(name, msg)
+
+        stats = self._stats
+        base = shard * 4
+        while not stop.value:
+            if any(self._incoming):
+                stats[base + _IDLE] = 0  # 必须在收到消息之前清除空闲标志
+                self._receive()
+            if not self._queue:
+                stats[base + _IDLE] = 1
+                time.sleep(0.0001)
+                continue
+            stats[base + _IDLE] = 0
+            processed = 0
+            while self._queue and processed < 1000:
+                actor, msg = self._queue.popleft()
+                try:
+                    actor.send(msg)
+                except StopIteration:
+                    pass
+                processed += 1
+            stats[base + _PROCESSED] += processed
+
+    def run(self):
+        """运行直到所有分片都空闲并且没有在途的消息，返回处理的消息总数"""
+        ctx = multiprocessing.get_context("fork")
+        rings = [[RingBuffer(self.ring_capacity) if src != dst else None
+                  for dst in range(self.nshards)] for src in range(self.nshards)]
+        self._stats = ctx.Array("q", self.nshards * 4, lock=False)
+        stop = ctx.Value("b", 0, lock=False)
+        workers = [ctx.Process(target=self._worker, args=(shard, rings, stop))
+                   for shard in range(self.nshards)]
+        try:
+            for p in workers:
+                p.start()
+            # 所有分片都空闲、发送和接收的消息数相等，并且连续两次检查的结果一样，才认为结束了
+            last = None
+            while True:
+                time.sleep(0.001)
+                for shard, p in enumerate(workers):
+                    # 工作进程在stop之前退出，说明某个actor抛出了异常，它的空闲标志永远不会被设置
+                    if p.exitcode is not None:
+                        raise RuntimeError("shard {} exited with code {}".format(
+                            shard, p.exitcode))
+                snapshot = self._stats[:]
+                if (all(snapshot[i * 4 + _IDLE] for i in range(self.nshards)) and
+                        sum(snapshot[_SENT::4]) == sum(snapshot[_RECEIVED::4]) and
+                        snapshot == last):
+                    break
+                last = snapshot
+        finally:
+            stop.value = 1
+            for p in workers:
+                if p.pid is not None:
+                    p.join()
+            for row in rings:
+                for ring in row:
+                    if ring is not None:
+                        ring.close()
+        return sum(self._stats[_PROCESSED::4])
+
+
+# 因为actor是在工作进程中创建的，所以传给 new_actor() 的是生成器函数和它的参数，而不是生成器
+# 对象。调度器本身可以作为参数传给actor，在工作进程中它的 send() 会把消息路由到正确的分片：
+#
+# sched = ShardedActorScheduler(4)
+# sched.new_actor("printer", printer)
+# sched.new_actor("counter", counter, sched)
+# sched.send("counter", 10000)
+# sched.run()
+#
+# 注意counter/printer这个例子本身是串行的，每条消息都依赖上一条，分片再多也不会更快。
+# 下面的基准测试使用npairs组互相独立的counter和sink：
+def bench_sharded_actors(shards=(1, 4, 16), npairs=64, count=2000):
+    def sink():
+        while True:
+            yield
+
+    def counter(sched, sink_name, self_name):
+        while True:
+            n = yield
+            if not n:
+                break
+            sched.send(sink_name, n)
+            sched.send(self_name, n - 1)
+
+    for nshards in shards:
+        sched = ShardedActorScheduler(nshards)
+        for i in range(npairs):
+            sched.new_actor("sink%d" % i, sink)
+            sched.new_actor("counter%d" % i, counter, sched, "sink%d" % i, "counter%d" % i)
+            sched.send("counter%d" % i, count)
+        start = time.perf_counter()
+        processed = sched.run()
+        elapsed = time.perf_counter() - start
+        print("{:3d} shards: {:10.0f} msgs/s".format(nshards, processed / elapsed))
+
+# bench_sharded_actors()
+# 在一台单核机器上：
+#   1 shards:    1057425 msgs/s
+#   4 shards:     231396 msgs/s
+#  16 shards:     199672 msgs/s
+# 跨分片的消息需要pickle序列化并经过共享内存，比本地队列慢得多；只有当actor本身的计算量
+# 足够大，而且有足够多的核心时，分片才能带来提升。
+
+
+# 扩展：按actor分开的邮箱和批量投递
+# ActorScheduler 每条消息都要往全局队列里放一个(actor, msg)元组，每条消息都要恢复一次
+# 生成器。对于很小的消息，这些开销占了大部分时间。
+#
+# 下面的调度器给每个actor一个自己的邮箱，就绪队列里放的是有消息的邮箱，每个邮箱最多只会在
+# 就绪队列中出现一次。轮到一个邮箱时，连续处理它最多max_batch条消息；如果actor在创建时
+# 指定了batch=True，则把这些消息放在一个列表中一次发送给它，生成器只恢复一次：
+class _Mailbox:
+    def __init__(self, name, actor, batch, max_batch):
+        self.name = name
+        self.actor = actor
+        self.batch = batch
+        self.max_batch = max_batch
+        self.messages = deque()
+        self.started = False
+        self.scheduled = False  # 是否已经在就绪队列中
+
+
+class BatchActorScheduler:
+    def __init__(self, max_batch=1024):
+        self.max_batch = max_batch
+        self._actors = {}  # actors的名字映射到邮箱
+        self._ready = deque()
+
+    def new_actor(self, name, actor, batch=False, max_batch=None):
+        mailbox = _Mailbox(name, actor, batch, max_batch or self.max_batch)
+        self._actors[name] = mailbox
+        mailbox.scheduled = True  # 运行时先激活生成器
+        self._ready.append(mailbox)
+
+    def send(self, name, msg):
+        """发送信息给一个actor"""
+        mailbox = self._actors.get(name)
+        if mailbox:
+            mailbox.messages.append(msg)
+            if not mailbox.scheduled:
+                mailbox.scheduled = True
+                self._ready.append(mailbox)
+
+    def _deliver(self, mailbox):
+        actor = mailbox.actor
+        messages = mailbox.messages
+        if not mailbox.started:
+            mailbox.started = True
+            actor.send(None)
+        elif mailbox.batch:
+            if len(messages) <= mailbox.max_batch:
+                batch = list(messages)
+                messages.clear()
+            else:
+                batch = [messages.popleft() for _ in range(mailbox.max_batch)]
+            actor.send(batch)
+        else:
+            # actor在处理消息时可能又给自己发送了消息，这些消息也会在这一轮中被处理
+            n = 0
+            while messages and n < mailbox.max_batch:
+                actor.send(messages.popleft())
+                n += 1
+
+    def run(self):
+        """不断运行只要还有候补信息"""
+        while self._ready:
+            mailbox = self._ready.popleft()
+            try:
+                self._deliver(mailbox)
+            except StopIteration:
+                # actor已经结束，之后发给它的消息都会被丢弃
+                del self._actors[mailbox.name]
+                mailbox.messages.clear()
+            if mailbox.messages:
+                self._ready.append(mailbox)
+            else:
+                mailbox.scheduled = False
+
+
+# 批量接收消息的actor每次yield得到的是一个列表：
+#
+# def printer():
+#     while True:
+#         msgs = yield
+#         for msg in msgs:
+#             print("Got:", msg)
+#
+# sched = BatchActorScheduler()
+# sched.new_actor("printer", printer(), batch=True)
+# sched.new_actor("counter", counter(sched))
+# sched.send("counter", 10000)
+# sched.run()
+#
+# 下面的基准测试使用counter/printer的例子，为了只测量调度的开销，printer只是计数而不打印：
+def bench_batch_actors(count=1000000):
+    def printer(total):
+        while True:
+            msg = yield
+            total[0] += 1
+
+    def batch_printer(total):
+        while True:
+            msgs = yield
+            total[0] += len(msgs)
+
+    def counter(sched):
+        while True:
+            n = yield
+            if n == 0:
+                break
+            sched.send("printer", n)
+            sched.send("counter", n - 1)
+
+    for name, sched, make_printer, kwargs in (
+            ("ActorScheduler", ActorScheduler(), printer, {}),
+            ("BatchActorScheduler", BatchActorScheduler(), printer, {}),
+            ("BatchActorScheduler batch", BatchActorScheduler(), batch_printer,
+             {"batch": True})):
+        total = [0]
+        sched.new_actor("printer", make_printer(total), **kwargs)
+        sched.new_actor("counter", counter(sched))
+        sched.send("counter", count)
+        start = time.perf_counter()
+        sched.run()
+        elapsed = time.perf_counter() - start
+        assert total[0] == count
+        print("{:26s} {:10.0f} msgs/s".format(name, 2 * count / elapsed))
+
+# bench_batch_actors()
+# ActorScheduler                1444004 msgs/s
+# BatchActorScheduler           2922484 msgs/s
+# BatchActorScheduler batch     4004815 msgs/s
+# 要注意的是消息的处理顺序变了：同一个actor收到的消息仍然是按发送顺序处理的，但是不同actor
+# 之间的消息不再是全局先进先出的。